@@ -0,0 +1,245 @@
+'''Helpers for caching page fragments and other values.
+
+Every fragment belongs to a named section. Each section has a generation
+number stored in memcache and fragments are cached under the current
+generation of their section. A write which changes the data behind a section
+bumps its generation, so all the fragments cached for the old generation are
+never read again and simply expire.
+
+Fragments are cached in two tiers: a small LRU cache in the memory of each
+instance, in front of memcache. Generations are always read from memcache,
+so a bump on one instance invalidates the fragments cached by every
+instance.
+
+A missing fragment is built by only one request at a time (single flight).
+Requests on the same instance wait on a lock; requests on other instances
+see the memcache lease taken by the builder and serve the previous (stale)
+version of the fragment, or wait for the new one if there is none.
+'''
+
+from collections import OrderedDict
+import logging
+import threading
+import time
+
+from google.appengine.api import memcache
+
+# sections of the home page
+SHOWCASE = 'showcase'
+COMPETITIONS = 'competitions'
+COMMENTS = 'comments'
+NOTES = 'notes'
+RESULTS = 'results'
+# the secret scoreboard
+STATS = 'stats'
+
+
+def competition(comp_id):
+    '''Return the section of one competition's results page. Each
+    competition has its own, so a change to one competition's results does
+    not invalidate the others.'''
+    return 'competition:%d' % comp_id
+
+# how long a fragment is kept in memcache (seconds)
+FRAGMENT_TIME = 24 * 60 * 60
+# how long a fragment built from queries is kept (seconds). The queries are
+# eventually consistent, so a fragment rebuilt just after a bump may miss the
+# write which caused it; it is rebuilt again soon.
+QUERY_TIME = 5 * 60
+# how many fragments, and for how long (seconds), an instance keeps in memory
+LOCAL_SIZE = 200
+LOCAL_TIME = 60 * 60
+# how long a builder may hold its lease (seconds) and how long the other
+# requests wait for it (seconds) before building the fragment themselves
+LEASE_TIME = 30
+LEASE_WAIT = 5
+LEASE_POLL = 0.1
+# builds on one instance are serialised by one of these locks, chosen by key
+_build_locks = [threading.Lock() for _ in range(32)]
+
+
+class LocalCache(object):
+    '''A thread-safe, size-bounded cache in instance memory. The least
+    recently used item is evicted when the cache is full, and items expire
+    after a time to live. Values are shared by all the requests on the
+    instance, so they must not be modified.'''
+    def __init__(self, size=LOCAL_SIZE, ttl=LOCAL_TIME):
+        self.size = size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_multi(self, keys):
+        '''Return a dict of key -> value for the keys found in the cache.'''
+        now = time.time()
+        found = {}
+        with self._lock:
+            for key in keys:
+                item = self._items.pop(key, None)
+                if item is None or item[0] < now:
+                    self.misses += 1
+                    continue
+                # reinsert as the most recently used
+                self._items[key] = item
+                found[key] = item[1]
+                self.hits += 1
+        return found
+
+    def set_multi(self, mapping, ttl=None):
+        expires = time.time() + min(ttl or self.ttl, self.ttl)
+        with self._lock:
+            for key, value in mapping.iteritems():
+                self._items.pop(key, None)
+                self._items[key] = (expires, value)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        '''Return the hit, miss and eviction counts and the size.'''
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'items': len(self._items),
+            }
+
+
+local = LocalCache()
+
+
+def _generation_key(section):
+    return 'generation:%s' % section
+
+
+def _fragment_key(section, generation, name=None):
+    if name is None:
+        return 'fragment:%s:%d' % (section, generation)
+    return 'fragment:%s:%d:%s' % (section, generation, name)
+
+
+def _stale_key(section, name=None):
+    if name is None:
+        return 'stale:%s' % section
+    return 'stale:%s:%s' % (section, name)
+
+
+def generations(sections):
+    '''Return a dict of the current generation number for each section.'''
+    keys = dict((_generation_key(s), s) for s in sections)
+    found = memcache.get_multi(keys.keys())
+    missing = dict((k, int(time.time())) for k in keys if k not in found)
+    if missing:
+        # If a generation has been evicted, restart it from the current time
+        # which is always greater than any number it had reached before.
+        memcache.add_multi(missing)
+        found.update(memcache.get_multi(missing.keys()))
+        for key, value in missing.iteritems():
+            found.setdefault(key, value)
+    return dict((keys[k], v) for k, v in found.iteritems())
+
+
+def bump(*sections):
+    '''Invalidate all cached fragments of the sections.'''
+    logging.info('cache: bump %s', ', '.join(sections))
+    for section in sections:
+        memcache.incr(_generation_key(section), initial_value=int(time.time()))
+
+
+def _get_multi(keys):
+    '''Return the values found for the keys, first from instance memory and
+    then from memcache.'''
+    found = local.get_multi(keys)
+    missing = [key for key in keys if key not in found]
+    if missing:
+        cached = memcache.get_multi(missing)
+        local.set_multi(cached)
+        found.update(cached)
+    return found
+
+
+def _set_multi(mapping, seconds=FRAGMENT_TIME):
+    local.set_multi(mapping, seconds)
+    memcache.set_multi(mapping, time=seconds)
+
+
+def _wait_for(key):
+    '''Wait for another request to build the value of a key. Return a dict
+    with the key and its value, or an empty dict if it was not built in
+    time.'''
+    deadline = time.time() + LEASE_WAIT
+    while time.time() < deadline:
+        time.sleep(LEASE_POLL)
+        found = _get_multi([key])
+        if found:
+            return found
+    return {}
+
+
+def _build(key, stale_key, builder, seconds=FRAGMENT_TIME):
+    '''Build the value of a key which is missing from the caches, making
+    sure that only one request builds it at a time.'''
+    with _build_locks[hash(key) % len(_build_locks)]:
+        # another request on this instance may have just built it
+        found = _get_multi([key])
+        if found:
+            return found[key]
+
+        lease = 'lease:%s' % key
+        if not memcache.add(lease, 1, time=LEASE_TIME):
+            # another instance is building it
+            stale = memcache.get(stale_key)
+            if stale is not None:
+                logging.info('cache: serving stale %s', stale_key)
+                return stale
+            found = _wait_for(key)
+            if found:
+                return found[key]
+            logging.warning('cache: gave up waiting for %s', key)
+
+        try:
+            logging.info('cache: building %s', key)
+            value = builder()
+            _set_multi({key: value}, seconds)
+            # kept (without a generation) to serve while the next one builds
+            memcache.set(stale_key, value)
+        finally:
+            memcache.delete(lease)
+        return value
+
+
+def fragments(builders, times=None):
+    '''Return a dict of section -> fragment for a dict of section -> builder.
+    Fragments missing from the caches are created by calling their builder
+    (with no arguments), one request at a time, and then cached for
+    FRAGMENT_TIME or the time (seconds) given for their section in times.'''
+    times = times or {}
+    gens = generations(builders.keys())
+    keys = dict((_fragment_key(s, g), s) for s, g in gens.iteritems())
+    cached = _get_multi(keys.keys())
+
+    results = {}
+    for key, section in keys.iteritems():
+        if key in cached:
+            results[section] = cached[key]
+        else:
+            results[section] = _build(
+                key, _stale_key(section), builders[section],
+                times.get(section, FRAGMENT_TIME))
+    return results
+
+
+def value(section, name, builder):
+    '''Return a named value which belongs to a section, such as the results
+    of one competition. It is created by calling the builder (with no
+    arguments) if it is missing from the caches.'''
+    generation = generations([section])[section]
+    key = _fragment_key(section, generation, name)
+    cached = _get_multi([key])
+    if key in cached:
+        return cached[key]
+    return _build(key, _stale_key(section, name), builder)
@@ -1,44 +1,30 @@
 #!/usr/bin/env python
 
-import webapp2
 import logging
 
+import cache
 from handler import BaseHandler
 from model import Comment
 
 
 class Comments(BaseHandler):
     def get(self):
-        user_id, user = self.get_user()
-
-        start = self.request.get('start')
-        logging.info('start: %s', start)
+        user = self.get_session()
 
-        if not start:
-            start = 0
-        else:
-            start = int(start)
-            if start > 1000000:
-                start = 0
+        cursor = self.get_cursor()
+        newer = cursor is not None and self.request.get('newer') == '1'
 
-        if start == 0:
-            before = 0
-            after = 10
-        else:
-            before = start - 10
-            after = start + 10
-
-        comments = list(Comment.recent_comments(10, start))
+        comments, older, newer = Comment.recent_comments(10, cursor, newer)
         logging.info(len(comments))
-        more_old = '' if len(comments) == 10 else 'disabled'
-        more_new = '' if start > 0 else 'disabled'
+        more_old = '' if older else 'disabled'
+        more_new = '' if newer else 'disabled'
 
         data = {
             'page_title': 'Comments',
             'user': user,
             'comments': comments,
-            'before': before,
-            'after': after,
+            'before': newer.urlsafe() if newer else '',
+            'after': older.urlsafe() if older else '',
             'more_old': more_old,
             'more_new': more_new,
         }
@@ -90,8 +76,9 @@ class CommentEdit(BaseHandler):
         logging.info(comment_text)
         logging.info(photo_id)
 
-        comment.text = comment_text
+        comment.set_text(comment_text)
         comment.put()
+        cache.bump(cache.COMMENTS)
 
         self.redirect('/photo/{}'.format(photo_id))
 
@@ -110,9 +97,3 @@ class CommentEdit(BaseHandler):
             return True, data
 
         return False, None
-
-routes = [
-    (r'/comment/edit/(\d+)', CommentEdit),
-    (r'/comments', Comments),
-]
-app = webapp2.WSGIApplication(routes=routes, debug=True)
@@ -2,27 +2,52 @@
 
 from calendar import monthrange
 from datetime import date
-import webapp2
+from google.appengine.api import taskqueue
+from google.appengine.api.datastore_errors import (
+    Timeout,
+    TransactionFailedError,
+)
+from google.appengine.ext import ndb
 import logging
 
+import cache
 from handler import BaseHandler
-from model import Competition, Photo, Scores, UserComp, csv_scores
+from model import (
+    DELETE_STAGES,
+    Competition,
+    CompetitionStats,
+    Photo,
+    Ballot,
+    Showcase,
+    UserComp,
+    csv_scores,
+    lookup,
+    prefetch,
+)
 from helper import OPEN, SCORING, COMPLETED, MONTHS
 
 
 class Competitions(BaseHandler):
     def get(self):
         '''Show the competitions page.'''
-        user_id, user = self.get_user()
+        user = self.get_session()
+
+        years = Competition.years()
+        try:
+            year = int(self.request.get('year'))
+        except ValueError:
+            year = years[0] if years else date.today().year
+
+        entered = UserComp.entered_comp_ids(user.key) if user else set()
 
         comps = []
 
-        for c in Competition.all():
+        for c in Competition.by_year(year):
+            if c.deleting:
+                continue
             month = c.month
             month_word = MONTHS[month]
-            user_photo = False
-            if user:
-                user_photo = Photo.competition_user(c, user) is not None
+            user_photo = c.key.id() in entered
             comps.append((
                 #month,
                 c.key.id(),
@@ -37,6 +62,8 @@ class Competitions(BaseHandler):
             'page_title': 'Competitions',
             'user': user,
             'comps': comps,
+            'year': year,
+            'years': years,
             'months': MONTHS
         }
         self.render('competitions.html', **data)
@@ -45,7 +72,7 @@ class Competitions(BaseHandler):
 class CompetitionHandler(BaseHandler):
     def get(self, comp_id=0):
         '''Show the competition page.'''
-        user_id, user = self.get_user()
+        user = self.get_session()
         comp_id = int(comp_id)
         comp = Competition.get_by_id(comp_id)
 
@@ -83,29 +110,56 @@ class CompetitionHandler(BaseHandler):
             self.redirect('/competitions')
             return
 
-        results = self.parse_scores(self.request.POST)
+        usercomp = self.get_usercomp(user, comp)
+        if comp.status != SCORING or not usercomp or usercomp.submitted_scores:
+            # not a competitor, or too early, too late or a second ballot
+            self.redirect('/competition/%d' % (comp_id))
+            return
 
-        for photo_id, score in results.iteritems():
-            photo = Photo.get_by_id(photo_id)
-            #photo = self.get_photo(photo_id)
-            new_score = Scores(
-                photo=photo.key,
-                user_from=user.key,
-                score=score
-            )
-            new_score.put()
+        try:
+            results = self.parse_scores(self.request.POST)
+        except ValueError:
+            results = None
 
-        # record that user has submitted scores for this comp
-        usercomp = self.get_usercomp(user, comp)
-        usercomp.submitted_scores = True
-        usercomp.put()
+        if not self.valid_scores(comp, usercomp, results):
+            data = {
+                'page_title': 'Error',
+                'user': user,
+                'error_msg': (
+                    'Your scores could not be submitted - every photograph '
+                    'except your own needs a score from 0 to 10.'
+                )
+            }
+            self.render('error.html', **data)
+            return
+
+        # store all the scores and record that the user has submitted scores
+        # for this comp in one transaction
+        try:
+            UserComp.submit_scores(usercomp.key, user.username, results)
+        except (TransactionFailedError, Timeout), e:
+            # Every ballot updates the competition's stats, so ballots which
+            # arrive together contend. A timeout may or may not have saved
+            # the ballot - the competition page shows which.
+            logging.warning('ballot not submitted: %s, %r', usercomp, e)
+            data = {
+                'page_title': 'Error',
+                'user': user,
+                'error_msg': (
+                    'Lots of people are submitting scores right now, so '
+                    'your scores may not have been saved. Please go back to '
+                    'the competition page - if it still asks for your '
+                    'scores, submit them again.'
+                )
+            }
+            self.render('error.html', **data)
+            return
 
         self.redirect('/competition/%d' % (comp_id))
 
     def view_open(self, user, comp_id, comp, data):
         '''Create the competition page when its status is Open.'''
-        #for p in Photo.competition_photos(comp):
-        photo_count = len(list(Photo.competition_photos(comp)))
+        photo_count = CompetitionStats.get_for(comp.key).photo_count
 
         data.update({
             'photo_count': photo_count
@@ -118,16 +172,17 @@ class CompetitionHandler(BaseHandler):
         to_score = user_comp and not user_comp.submitted_scores
 
         photos = []
+        ballot = None
+        if user and not to_score:
+            # all the user's scores are in one ballot
+            ballot = Ballot.key_for(user.key, comp.key).get()
+        scores = ballot.photo_scores() if ballot else {}
         for p in Photo.competition_photos(comp):
         #for p in self.get_competition_photos(comp_id, comp=comp):
             title, url, thumb, _, _, _, _ = p.data(128)
             if user:
-                user_photo = p.user.get() == user
-                if not to_score:
-                    s = Scores.score_from_user(p, user)
-                    score = s.score if s else None
-                else:
-                    score = None
+                user_photo = p.user == user.key
+                score = scores.get(p.key.id())
             else:
                 user_photo = False
                 score = None
@@ -142,7 +197,11 @@ class CompetitionHandler(BaseHandler):
 
     def view_complete(self, user, comp_id, comp, data):
         '''Create the competition page when its status is Completed.'''
-        data['photos'] = list(Photo.competition_result(comp))
+        data['photos'] = cache.value(
+            cache.competition(comp_id),
+            'photos',
+            lambda: Photo.competition_result(comp)
+        )
         self.render('competition-complete.html', **data)
 
     def parse_scores(self, scores):
@@ -153,6 +212,24 @@ class CompetitionHandler(BaseHandler):
             results[int(photo_id)] = int(score)
         return results
 
+    def valid_scores(self, comp, usercomp, results):
+        '''Check that there is a score, from 0 to 10, for every photo in the
+        competition except the user's own photo.'''
+        if not results:
+            return False
+        photo_keys = Photo.query(Photo.competition == comp.key).fetch(
+            keys_only=True)
+        expected = set(key.id() for key in photo_keys)
+        expected.discard(usercomp.photo.id() if usercomp.photo else None)
+        if set(results) != expected:
+            logging.warning(
+                'invalid ballot: %s, expected photos: %s',
+                results,
+                expected
+            )
+            return False
+        return all(0 <= score <= 10 for score in results.itervalues())
+
     def get_usercomp(self, user, comp):
         '''Return UserComp object for user and competition.'''
         if user and comp:
@@ -239,6 +316,7 @@ class CompetitionNew(BaseHandler):
             end=end
         )
         new_comp.put()
+        cache.bump(cache.COMPETITIONS)
         self.redirect('/competition/admin')
 
 
@@ -298,16 +376,21 @@ class CompetitionModify(BaseHandler):
         '''Create the data dictionary for the renderer.'''
         users = []
         photos = []
+        standings = []
         status = comp.status
-        for uc in comp.users():
-            user1 = uc.user.get()
+        if status == SCORING:
+            stats = CompetitionStats.get_for(comp.key)
+        for uc in prefetch(comp.users(), 'user'):
+            user1 = lookup(uc.user)
             users.append((
                 user1,
                 'Yes' if uc.submitted_scores else 'No'
             ))
             if status == OPEN:
-                photo = Photo.competition_user(comp, user1)
-                photos.append(photo.key.id())
+                photos.append(uc.photo.id())
+            elif status == SCORING and uc.photo:
+                standings.append((stats.photo_total(uc.photo), user1.username))
+        standings.sort(reverse=True)
 
         data = {
             'page_title': 'Modify Competition',
@@ -319,6 +402,8 @@ class CompetitionModify(BaseHandler):
             'user': user,
             'users': users,
             'photos': photos,
+            'standings': standings,
+            'ballots': stats.ballots if status == SCORING else 0,
             'comp_id': comp.key.id(),
             'status_values': (
                 (0, 'Open'),
@@ -370,15 +455,19 @@ class CompetitionModify(BaseHandler):
 
     def _calculate_scores(self, comp):
         '''Calculate the scores for a completed competition.'''
-        all_scores = UserComp.all_scores_submitted(comp)
-        if not all_scores:
+        usercomps = list(comp.users())
+        if not all(uc.submitted_scores for uc in usercomps):
             return False
 
-        results = []
-        for photo in Photo.competition_photos(comp):
-            total_score = Scores.photo_score(photo)
-            results.append((total_score, photo))
-        results.sort(reverse=True)
+        # the totals have been kept up to date as the ballots arrived
+        stats = CompetitionStats.get_for(comp.key)
+        if stats.ballots != len(usercomps):
+            logging.warning('%s: running totals have drifted', comp)
+            stats = CompetitionStats.reconcile(comp)
+
+        photos = ndb.get_multi([uc.photo for uc in usercomps if uc.photo])
+        results = [(stats.photo_total(p.key), p) for p in photos if p]
+        results.sort(key=lambda result: result[0], reverse=True)
 
         # calculate positions
         position = 1
@@ -390,18 +479,31 @@ class CompetitionModify(BaseHandler):
             #full_results.append((position, score, photo))
             photo.position = position
             photo.total_score = score
-            photo.put()
             prev_score = score
+        stats.results = [photo.key.id() for _, photo in results]
+        ndb.put_multi([photo for _, photo in results] + [stats])
 
         return True
 
     def _update_competition(self, comp, title, description, status):
         '''Update the competition details and redirect to admin page.'''
+        status_changed = comp.status != status
         comp.title = title
         comp.description = description
         comp.status = status
         comp.finished = True if status == 2 else False
         comp.put()
+        sections = [
+            cache.COMPETITIONS,
+            cache.RESULTS,
+            cache.competition(comp.key.id())
+        ]
+        if status_changed:
+            photos = comp.update_photo_status()
+            if status == COMPLETED:
+                Showcase.add_photos(photos)
+                sections.append(cache.SHOWCASE)
+        cache.bump(*sections)
         self.redirect('/competition/admin')
 
     def _report_error(self, comp, user, error):
@@ -410,6 +512,23 @@ class CompetitionModify(BaseHandler):
         self.render('competition-modify.html', **data)
 
 
+class CompetitionReconcile(BaseHandler):
+    '''Recalculate a competition's running totals from the submitted
+    scores.'''
+    def post(self, comp_id):
+        user_id, user = self.get_user()
+        if not user or not user.admin:
+            self.redirect('/')
+            return
+
+        comp_id = int(comp_id)
+        comp = Competition.get_by_id(comp_id)
+        if comp:
+            CompetitionStats.reconcile(comp)
+
+        self.redirect('/competition/modify/%d' % comp_id)
+
+
 class CompetitionScores(BaseHandler):
     def get(self, comp_id):
         # should check for logged in user cookie
@@ -456,21 +575,63 @@ class CompetitionDelete(BaseHandler):
             return
 
         comp_id = int(comp_id)
-        comp = Competition.get_by_id(comp_id)
+        comp = self.start_deleting(comp_id)
         logging.info('Deleting comp: %s' % comp)
-
-        comp.delete()
+        cache.bump(cache.COMPETITIONS)
 
         self.redirect('/competition/admin')
 
+    @staticmethod
+    @ndb.transactional
+    def start_deleting(comp_id):
+        '''Mark the competition as deleting and add the first delete task,
+        in one transaction, so a competition is never marked without a task
+        to delete it.'''
+        comp = Competition.get_by_id(comp_id)
+        if not comp.deleting:
+            comp.deleting = True
+            comp.deleted_count = 0
+            comp.put()
+            taskqueue.add(
+                url='/competition/delete-task',
+                params={'comp_id': comp_id, 'stage': DELETE_STAGES[0]},
+                transactional=True
+            )
+        return comp
+
+
+class CompetitionDeleteTask(BaseHandler):
+    '''Task queue handler which deletes a competition one chunk at a time.
+
+    Each task deletes one chunk and then adds a task for the next chunk, so a
+    deletion of any size survives request deadlines and resumes from its
+    cursor if a task is retried.
+    '''
+    def post(self):
+        comp_id = int(self.request.get('comp_id'))
+        stage = self.request.get('stage')
+        cursor = self.get_cursor()
+
+        comp = Competition.get_by_id(comp_id)
+        if not comp:
+            logging.warning('delete task: no competition %d', comp_id)
+            return
+
+        stage, cursor, count = comp.delete_chunk(stage, cursor)
+        if stage is None:
+            logging.info('Deleted comp: %s' % comp)
+            cache.bump(
+                cache.COMPETITIONS,
+                cache.RESULTS,
+                cache.COMMENTS,
+                cache.SHOWCASE
+            )
+            return
+
+        comp.deleted_count += count
+        comp.put()
 
-routes = [
-    (r'/competitions', Competitions),
-    (r'/competition/(\d+)', CompetitionHandler),
-    (r'/competition/admin', CompetitionAdmin),
-    (r'/competition/new', CompetitionNew),
-    (r'/competition/modify/(\d+)', CompetitionModify),
-    (r'/competition/scores/(\d+)/scores_\d+.csv', CompetitionScores),
-    (r'/competition/delete/(\d+)', CompetitionDelete),
-]
-app = webapp2.WSGIApplication(routes=routes, debug=True)
+        params = {'comp_id': comp_id, 'stage': stage}
+        if cursor:
+            params['cursor'] = cursor.urlsafe()
+        taskqueue.add(url='/competition/delete-task', params=params)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+'''Precompile the jinja2 templates before deploying.
+
+    python compile_templates.py
+
+Every template under templates/ (including templates/help/) is compiled to a
+python module in templates_compiled/, which handler.py loads with a
+jinja2.ModuleLoader. A new instance then renders its first page without
+parsing or compiling any templates. Run this again whenever a template
+changes - the development server always reads the templates directly.
+
+The compiled templates are only used while they match the templates and the
+jinja2 version they were compiled from (see manifest()), so a deploy which
+forgot to recompile serves the template files rather than stale modules.
+'''
+
+import hashlib
+import os
+import re
+import shutil
+import sys
+
+import jinja2
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_DIR = os.path.join(ROOT, 'templates')
+COMPILED_DIR = os.path.join(ROOT, 'templates_compiled')
+MANIFEST = os.path.join(COMPILED_DIR, 'MANIFEST')
+
+
+def manifest(template_dir=TEMPLATE_DIR):
+    '''Return a str identifying the jinja2 version and the contents of all
+    the templates.'''
+    digest = hashlib.sha1()
+    for directory, _, files in sorted(os.walk(template_dir)):
+        for name in sorted(files):
+            path = os.path.join(directory, name)
+            # the same name on Windows, where templates may be compiled,
+            # and on the instance
+            relative = os.path.relpath(path, template_dir)
+            digest.update(relative.replace(os.sep, '/'))
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+    return 'jinja2 %s %s' % (jinja2.__version__, digest.hexdigest())
+
+
+def deployed_jinja2_version():
+    '''Return the jinja2 version pinned in app.yaml.'''
+    with open(os.path.join(ROOT, 'app.yaml')) as f:
+        match = re.search(
+            r'- name: jinja2\s+version: "?([^"\s]+)"?', f.read())
+    return match.group(1) if match else None
+
+
+def main():
+    deployed = deployed_jinja2_version()
+    if not jinja2.__version__.startswith(deployed or '?'):
+        sys.exit('jinja2 %s is installed but app.yaml deploys jinja2 %s' % (
+            jinja2.__version__, deployed))
+
+    # the options which affect the generated code must match handler.env
+    env = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(TEMPLATE_DIR),
+        autoescape=True
+    )
+    if os.path.isdir(COMPILED_DIR):
+        # remove the modules of deleted templates
+        shutil.rmtree(COMPILED_DIR)
+    env.compile_templates(COMPILED_DIR, zip=None)
+    with open(MANIFEST, 'w') as f:
+        f.write(manifest())
+    print 'compiled %d templates to %s' % (
+        len(env.list_templates()), COMPILED_DIR)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,121 @@
+from google.appengine.api.datastore_errors import BadValueError
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 import jinja2
 import os
 import logging
+import time
 import webapp2
 from webapp2_extras.securecookie import SecureCookieSerializer
 
-from model import User
+from compile_templates import MANIFEST, manifest
+from model import User, lookup, reset_identity_map
 from secret_key import SECRET
 
+# how long a login session lasts (seconds)
+SESSION_AGE = 30 * 24 * 60 * 60
+
 template_dir = os.path.join(os.path.dirname(__file__), 'templates')
+# templates precompiled by compile_templates.py
+compiled_dir = os.path.join(os.path.dirname(__file__), 'templates_compiled')
+
+
+def template_loader():
+    '''Return the loader for the templates. In production the precompiled
+    templates are used when they exist and their manifest matches the
+    templates and jinja2, so templates are not parsed on a new instance. The
+    development server always reads the template files.'''
+    loader = jinja2.FileSystemLoader(template_dir)
+    development = os.environ.get('SERVER_SOFTWARE', '').startswith(
+        'Development')
+    if development or not os.path.isdir(compiled_dir):
+        return loader
+    try:
+        with open(MANIFEST) as f:
+            compiled = f.read()
+    except IOError:
+        compiled = None
+    if compiled != manifest(template_dir):
+        logging.warning('templates_compiled is out of date - run '
+                        'compile_templates.py; using the template files')
+        return loader
+    # fall back to the template files for any template not compiled
+    return jinja2.ChoiceLoader([jinja2.ModuleLoader(compiled_dir), loader])
+
+
 env = jinja2.Environment(
-    loader=jinja2.FileSystemLoader(template_dir),
+    loader=template_loader(),
     autoescape=True
 )
 
 
+class Session(object):
+    '''The logged in user as recorded in the signed session cookie.
+
+    It has the user's key, username and admin flag, which is all most pages
+    need, so reading it needs no datastore access. The full User entity is
+    loaded by user() only when it is needed.
+    '''
+    def __init__(self, user_id, username, admin, version, expires):
+        self.id = user_id
+        self.username = username
+        self.admin = admin
+        self.version = version
+        self.expires = expires
+        self.key = ndb.Key(User, user_id)
+
+    @classmethod
+    def for_user(cls, user):
+        expires = int(time.time()) + SESSION_AGE
+        return cls(
+            user.key.id(),
+            user.username,
+            user.admin,
+            user.session_version,
+            expires
+        )
+
+    @classmethod
+    def parse(cls, value):
+        '''Return the session from the cookie payload, or None if it is not
+        a valid session.'''
+        try:
+            user_id, username, admin, version, expires = value.split('|')
+            session = cls(
+                int(user_id), username, admin == '1', int(version), int(expires)
+            )
+        except ValueError:
+            # not a session payload (or an old style cookie)
+            return None
+        if session.expires < time.time():
+            return None
+        if session.version != User.session_version_for(session.id):
+            # the session has been revoked or the user deleted
+            return None
+        return session
+
+    def serialize(self):
+        return '%d|%s|%d|%d|%d' % (
+            self.id,
+            self.username,
+            1 if self.admin else 0,
+            self.version,
+            self.expires
+        )
+
+    def user(self):
+        '''Return the full User entity.'''
+        return lookup(self.key)
+
+
 class BaseHandler(webapp2.RequestHandler):
 
     def initialize(self, request, response):
         super(BaseHandler, self).initialize(request, response)
         # initialise with secret key
         self.cookie_serializer = SecureCookieSerializer(SECRET)
+        # each request starts with an empty entity identity map
+        reset_identity_map()
 
     def write(self, *args, **kwgs):
         self.response.out.write(*args, **kwgs)
@@ -31,28 +127,49 @@ class BaseHandler(webapp2.RequestHandler):
     def render(self, template, **params):
         self.write(self.render_str(template, **params))
 
-    def get_cookie(self):
-        user_cookie = self.request.cookies.get('userid')
-        if user_cookie:
-            user_cookie = self.cookie_serializer.deserialize(
-                'userid',
-                user_cookie
-            )
-            if not user_cookie:
-                # invalid cookie signature
-                return None, ''
-            user_id, username = user_cookie.split('|')
-            user_id = int(user_id)
-            return user_id, username
-        else:
-            return None, ''
+    def get_cursor(self, name='cursor'):
+        '''Return the query cursor from a request parameter, or None if it
+        is missing or invalid.'''
+        urlsafe = self.request.get(name)
+        if not urlsafe:
+            return None
+        try:
+            return Cursor(urlsafe=urlsafe)
+        except BadValueError:
+            logging.warning('invalid cursor: %s', urlsafe)
+            return None
+
+    def set_session(self, user):
+        '''Sign the user in by setting the session cookie.'''
+        session = Session.for_user(user)
+        value = self.cookie_serializer.serialize('userid', session.serialize())
+        self.response.set_cookie('userid', value)
+
+    def get_session(self):
+        '''Return the Session of the logged in user, or None.'''
+        if not hasattr(self, '_session'):
+            self._session = None
+            user_cookie = self.request.cookies.get('userid')
+            if user_cookie:
+                # None if the cookie signature is invalid or it is too old
+                value = self.cookie_serializer.deserialize(
+                    'userid',
+                    user_cookie,
+                    max_age=SESSION_AGE
+                )
+                if value:
+                    self._session = Session.parse(value)
+        return self._session
 
     def get_user(self):
-        user_id, username = self.get_cookie()
-        logging.info('get_user -> {}, {}'.format(user_id, username))
-        if not user_id:
+        '''Return the user id and the full User entity of the logged in
+        user. Pages which only need the id, username or admin flag should use
+        get_session instead.'''
+        session = self.get_session()
+        logging.info('get_user -> {}'.format(
+            session.serialize() if session else None))
+        if not session:
             # no logged in user cookie
             return None, None
 
-        user = User.get_by_id(user_id)
-        return user_id, user
+        return session.id, session.user()
@@ -1,11 +1,29 @@
 #!/usr/bin/env python
 
-import webapp2
+from google.appengine.api.images import get_serving_url
+from google.appengine.ext import ndb
 
+import logging
+
+import cache
 from handler import BaseHandler
 from model import (
+    Competition,
+    CompetitionStats,
     Photo,
+    Comment,
+    ResetToken,
+    Note,
+    Ballot,
+    Scores,
+    Showcase,
+    User,
+    UserComp,
+    UserEmail,
+    UserName,
     blob_exif,
+    lookup,
+    prefetch,
 )
 
 
@@ -73,9 +91,305 @@ class ExifData(BaseHandler):
         self.render('help/exif.html', **data)
 
 
-routes = [
-    (r'/help/comments', Comments),
-    #(r'/help/exif', ExifData),
-    (r'/help/exif/(\d+)', ExifData),
-]
-app = webapp2.WSGIApplication(routes=routes, debug=True)
+class Denormalize(BaseHandler):
+    '''Copy the username onto existing Photos, Comments, Notes and Scores,
+    and the competition status onto existing Photos.'''
+    def get(self):
+        user_id, user = self.get_user()
+
+        if not user or not user.admin:
+            self.redirect('/')
+            return
+
+        results = []
+        kinds = (
+            (Photo, 'user'), (Comment, 'user'), (Note, 'user'),
+            (Scores, 'user_from')
+        )
+        for model, attr in kinds:
+            entities = prefetch(model.query(), attr)
+            for entity in entities:
+                entity.username = lookup(getattr(entity, attr)).username
+            if model is Photo:
+                prefetch(entities, 'competition')
+                for photo in entities:
+                    if photo.competition:
+                        comp = lookup(photo.competition)
+                        photo.comp_status = comp.status
+            ndb.put_multi(entities)
+            results.append((model.__name__, len(entities)))
+        cache.bump(cache.COMMENTS, cache.NOTES, cache.RESULTS)
+
+        data = {
+            'user': user,
+            'page_title': 'Denormalize usernames and status',
+            'results': results,
+        }
+
+        self.render('help/backfill.html', **data)
+
+
+class RenderMarkdown(BaseHandler):
+    '''Store the rendered markdown html for existing Comments, Notes and User
+    bios.'''
+    def get(self):
+        user_id, user = self.get_user()
+
+        if not user or not user.admin:
+            self.redirect('/')
+            return
+
+        results = []
+        for model in (Comment, Note):
+            entities = model.query().fetch()
+            for entity in entities:
+                entity.set_text(entity.text)
+            ndb.put_multi(entities)
+            results.append((model.__name__, len(entities)))
+
+        users = User.query().fetch()
+        for user1 in users:
+            user1.set_bio(user1.bio)
+        ndb.put_multi(users)
+        results.append(('User', len(users)))
+        cache.bump(cache.COMMENTS, cache.NOTES)
+
+        data = {
+            'user': user,
+            'page_title': 'Render markdown',
+            'results': results,
+        }
+
+        self.render('help/backfill.html', **data)
+
+
+class ServingUrls(BaseHandler):
+    '''Store the image serving url for existing Photos.'''
+    def get(self):
+        user_id, user = self.get_user()
+
+        if not user or not user.admin:
+            self.redirect('/')
+            return
+
+        photos = [p for p in Photo.query() if not p.serving_url]
+        for photo in photos:
+            photo.serving_url = get_serving_url(photo.blob)
+        ndb.put_multi(photos)
+
+        data = {
+            'user': user,
+            'page_title': 'Image serving urls',
+            'results': [('Photo', len(photos))],
+        }
+
+        self.render('help/backfill.html', **data)
+
+
+class RebuildShowcase(BaseHandler):
+    '''Recreate the home page showcase pool from all the photos in completed
+    competitions.'''
+    def get(self):
+        user_id, user = self.get_user()
+
+        if not user or not user.admin:
+            self.redirect('/')
+            return
+
+        pool = Showcase.rebuild()
+        cache.bump(cache.SHOWCASE)
+
+        data = {
+            'user': user,
+            'page_title': 'Rebuild showcase',
+            'results': [('Showcase photos', len(pool.photos))],
+        }
+
+        self.render('help/backfill.html', **data)
+
+
+class Rekey(BaseHandler):
+    '''Rewrite UserComp and Scores entities created with automatic ids so
+    that they have their deterministic keys.'''
+    def get(self):
+        user_id, user = self.get_user()
+
+        if not user or not user.admin:
+            self.redirect('/')
+            return
+
+        old_usercomps = [
+            uc for uc in UserComp.query()
+            if not isinstance(uc.key.id(), basestring)
+        ]
+        new_usercomps = []
+        for uc in old_usercomps:
+            photo_key = Photo.query(
+                Photo.competition == uc.comp,
+                Photo.user == uc.user,
+            ).get(keys_only=True)
+            new_usercomps.append(UserComp(
+                key=UserComp.key_for(uc.user, uc.comp),
+                user=uc.user,
+                comp=uc.comp,
+                photo=photo_key,
+                submitted_scores=uc.submitted_scores
+            ))
+        ndb.put_multi(new_usercomps)
+        ndb.delete_multi([uc.key for uc in old_usercomps])
+
+        old_scores = prefetch(
+            (s for s in Scores.query() if s.key.parent() is None), 'photo')
+        new_scores = []
+        for score in old_scores:
+            photo = lookup(score.photo)
+            if photo is None:
+                # score for a deleted photo - just remove it
+                continue
+            new_scores.append(Scores(
+                key=Scores.key_for(photo, score.user_from),
+                photo=score.photo,
+                user_from=score.user_from,
+                username=score.username,
+                score=score.score
+            ))
+        ndb.put_multi(new_scores)
+        ndb.delete_multi([score.key for score in old_scores])
+
+        data = {
+            'user': user,
+            'page_title': 'Rekey UserComp and Scores',
+            'results': [
+                ('UserComp', len(new_usercomps)),
+                ('Scores', len(new_scores)),
+            ],
+        }
+
+        self.render('help/backfill.html', **data)
+
+
+class MigrateBallots(BaseHandler):
+    '''Combine the Scores from each user for each competition into a Ballot,
+    then delete the Scores.'''
+    def get(self):
+        user_id, user = self.get_user()
+
+        if not user or not user.admin:
+            self.redirect('/')
+            return
+
+        old_scores = prefetch(Scores.query(), 'photo', 'user_from')
+        ballots = {}
+        for score in old_scores:
+            photo = lookup(score.photo)
+            if photo is None:
+                # score for a deleted photo
+                continue
+            key = Ballot.key_for(score.user_from, photo.competition)
+            if key not in ballots:
+                ballots[key] = Ballot(
+                    key=key,
+                    user=score.user_from,
+                    comp=photo.competition,
+                    username=lookup(score.user_from).username
+                )
+            ballots[key].photos.append(photo.key.id())
+            ballots[key].scores.append(score.score)
+        ndb.put_multi(ballots.values())
+        ndb.delete_multi([score.key for score in old_scores])
+
+        data = {
+            'user': user,
+            'page_title': 'Migrate Scores to Ballots',
+            'results': [
+                ('Scores', len(old_scores)),
+                ('Ballot', len(ballots)),
+            ],
+        }
+
+        self.render('help/backfill.html', **data)
+
+
+class CompetitionCounts(BaseHandler):
+    '''Recalculate the stats (totals, photo, participant and ballot counts)
+    of every competition.'''
+    def get(self):
+        user_id, user = self.get_user()
+
+        if not user or not user.admin:
+            self.redirect('/')
+            return
+
+        comps = list(Competition.query())
+        for comp in comps:
+            CompetitionStats.reconcile(comp)
+
+        data = {
+            'user': user,
+            'page_title': 'Recalculate competition stats',
+            'results': [('Competitions', len(comps))],
+        }
+
+        self.render('help/backfill.html', **data)
+
+
+class UserIndex(BaseHandler):
+    '''Create the UserName, UserEmail and ResetToken entities for existing
+    users.'''
+    def get(self):
+        user_id, user = self.get_user()
+
+        if not user or not user.admin:
+            self.redirect('/')
+            return
+
+        names = {}
+        emails = {}
+        tokens = []
+        duplicates = 0
+        for u in User.query():
+            for markers, kind, value in (
+                    (names, UserName, u.username), (emails, UserEmail, u.email)):
+                if value in markers:
+                    logging.warning('duplicate %s: %s', kind.__name__, value)
+                    duplicates += 1
+                    continue
+                markers[value] = kind(key=kind.key_for(value), user=u.key)
+            if u.pass_reset_code and u.pass_reset_expire:
+                tokens.append(ResetToken(
+                    id=u.pass_reset_code,
+                    user=u.key,
+                    expires=u.pass_reset_expire
+                ))
+        ndb.put_multi(names.values() + emails.values() + tokens)
+
+        data = {
+            'user': user,
+            'page_title': 'Index users',
+            'results': [
+                ('UserName', len(names)),
+                ('UserEmail', len(emails)),
+                ('ResetToken', len(tokens)),
+                ('Duplicates (see log)', duplicates),
+            ],
+        }
+
+        self.render('help/backfill.html', **data)
+
+
+class CacheStats(BaseHandler):
+    '''Show the hit and miss counts of this instance's local cache.'''
+    def get(self):
+        user_id, user = self.get_user()
+
+        if not user or not user.admin:
+            self.redirect('/')
+            return
+
+        data = {
+            'user': user,
+            'page_title': 'Instance cache',
+            'results': sorted(cache.local.stats().items()),
+        }
+
+        self.render('help/cache.html', **data)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+'''Measure how long a new instance takes to import each entry point.
+
+    python import_times.py /path/to/google_appengine [repeats]
+
+app.yaml sends every URL to urls.app, which imports a handler module on the
+first request for one of its pages. For urls and each handler module this
+imports the module in a fresh python process, as a cold instance would,
+and prints the median time over the repeats, slowest first.
+'''
+
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# run in a new process: set up the App Engine paths, then time one import
+TIMER = '''
+import sys, time
+sys.path.insert(0, %(sdk)r)
+import dev_appserver
+dev_appserver.fix_sys_path()
+sys.path.insert(0, %(root)r)
+started = time.time()
+import %(module)s
+print (time.time() - started) * 1000
+'''
+
+
+def entry_points(sdk):
+    '''Return urls and the handler modules named in its routes.'''
+    # urls imports webapp2, which is found through the App Engine paths
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, ROOT)
+    import urls
+    modules = set(handler.rsplit('.', 1)[0] for _, handler in urls.routes)
+    return ['urls'] + sorted(modules)
+
+
+def import_time(sdk, module):
+    '''Return the time (ms) taken to import the module in a new process.'''
+    code = TIMER % {'sdk': sdk, 'root': ROOT, 'module': module}
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT)
+    return float(output.strip().splitlines()[-1])
+
+
+def main():
+    if len(sys.argv) < 2:
+        print __doc__
+        sys.exit(1)
+    sdk = os.path.abspath(sys.argv[1])
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    results = []
+    for module in entry_points(sdk):
+        times = sorted(import_time(sdk, module) for _ in range(repeats))
+        results.append((times[len(times) // 2], module))
+
+    for median, module in sorted(results, reverse=True):
+        print '%8.1f ms  %s' % (median, module)
+
+
+if __name__ == '__main__':
+    main()
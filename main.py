@@ -1,64 +1,66 @@
 #!/usr/bin/env python
 
 import logging
-from random import shuffle
-import webapp2
-import markdown
+import random
 
+import cache
 from handler import BaseHandler
-from helper import MONTHS, ordinal, COMPLETED
+from helper import MONTHS, ordinal
 from model import (
-    Photo,
     Competition,
     Comment,
     Note,
+    Showcase,
     recently_completed_competitions,
 )
 
 
 class Home(BaseHandler):
     def get(self):
-        user_id, user = self.get_user()
+        user = self.get_session()
+        sections = self.sections()
         data = {
             #'page_title': 'Monthly Photographs 2013',
-            'photos': self.random_images(4),
+            'photos': self.random_images(sections[cache.SHOWCASE], 4),
             'user': user,
-            'competitions': self.competitions_in_progress(),
-            'comments': self.recent_comments(),
-            'results': self.recent_results(),
-            'notes': Note.recent_notes(),
+            'competitions': sections[cache.COMPETITIONS],
+            'comments': sections[cache.COMMENTS],
+            'results': sections[cache.RESULTS],
+            'notes': sections[cache.NOTES],
         }
         self.render('home.html', **data)
 
-    def random_images(self, number=3):
-        photo_keys = list(Photo.query().fetch(keys_only=True))
-        shuffle(photo_keys)
-        photos = []
-        for key in photo_keys:
-            photo = key.get()
-            if photo is None:
-                # on the dev server, after a photo delete, the key is still in
-                # the database when the homepage loads. So need this check to
-                # make sure this is not the recently deleted photo.
-                # TODO: fix this...
-                continue
-            if photo.competition and photo.competition.get().status == COMPLETED:
-                # only view photos belonging to completed competition -
-                title = photo.title
-                if not title:
-                    title = 'Untitled'
-                user = photo.user.get().username
-                photos.append((key.id(), photo.url(size=800), title, user))
-                if len(photos) == number:
-                    # Once we have the required number of photos, we can quit the
-                    # loop
-                    break
+    @classmethod
+    def sections(cls):
+        '''Return the sections of the page which are the same for every
+        visitor. They are cached until a write changes them; the sections
+        built from queries only for a short time, because a query run just
+        after the write may not see it yet.'''
+        return cache.fragments({
+            cache.SHOWCASE: lambda: Showcase.get_pool().photos or [],
+            cache.COMPETITIONS: cls.competitions_in_progress,
+            cache.COMMENTS: cls.recent_comments,
+            cache.RESULTS: cls.recent_results,
+            cache.NOTES: lambda: Note.recent_notes()[0],
+        }, times={
+            cache.COMPETITIONS: cache.QUERY_TIME,
+            cache.COMMENTS: cache.QUERY_TIME,
+            cache.RESULTS: cache.QUERY_TIME,
+            cache.NOTES: cache.QUERY_TIME,
+        })
+
+    def random_images(self, showcase, number=3):
+        # only photos belonging to completed competitions are in the showcase
+        photos = random.sample(showcase, min(number, len(showcase)))
         #logging.info('random photos: %s', photos)
         return photos
 
-    def competitions_in_progress(self):
+    @staticmethod
+    def competitions_in_progress():
         competition_data = []
         for comp in Competition.in_progress():
+            if comp.deleting:
+                continue
             competition_data.append((
                 comp.key.id(),
                 comp.title,
@@ -69,24 +71,21 @@ class Home(BaseHandler):
             ))
         return competition_data
 
-    def recent_comments(self):
+    @staticmethod
+    def recent_comments():
         comments = []
-        for comment in Comment.recent_comments(10):
-            text = markdown.markdown(
-                comment.text,
-                output_format='html5',
-                safe_mode='replace',
-            )
+        for comment in Comment.recent_comments(10)[0]:
             comments.append((
-                text,
+                comment.markdown(),
                 comment.user.id(),
-                comment.user.get().username,
+                comment.username,
                 comment.photo.id(),
                 comment.format_date()
             ))
         return comments
 
-    def recent_results(self):
+    @staticmethod
+    def recent_results():
         results = []
         for comp, photos in recently_completed_competitions():
             new_photos = []
@@ -97,7 +96,7 @@ class Home(BaseHandler):
                     classes[photo.position - 1],
                     photo.total_score,
                     photo.user.id(),
-                    photo.user.get().username,
+                    photo.username,
                 ))
             results.append((comp, new_photos))
         return results
@@ -105,7 +104,7 @@ class Home(BaseHandler):
 
 class About(BaseHandler):
     def get(self):
-        user_id, user = self.get_user()
+        user = self.get_session()
 
         data = {
             'user': user,
@@ -113,12 +112,3 @@ class About(BaseHandler):
         }
 
         self.render('about.html', **data)
-
-
-app = webapp2.WSGIApplication(
-    [
-        (r'/', Home),
-        (r'/about', About)
-    ],
-    debug=True
-)
@@ -1,20 +1,109 @@
 
-from google.appengine.ext import blobstore
+# The blobstore and images APIs and markdown are imported by the functions
+# which use them. Every request imports this module, but only a few of them
+# render markdown or handle image data.
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 #from google.appengine.ext import db
-from google.appengine.api.images import Image, get_serving_url
-import markdown
 
 import csv
 import datetime
 import logging
 import StringIO
+import threading
 
-from helper import COMPLETED, SCORING, ordinal, MONTHS
+from helper import OPEN, COMPLETED, SCORING, ordinal, MONTHS
 
 # the maximum length of the longest dimension of on uploaded photo
 MAX_SIZE = 800
 
+# a competition is deleted by a task queue job, one chunk of entities per task
+DELETE_CHUNK = 50
+DELETE_STAGES = ('photos', 'usercomps', 'ballots', 'competition')
+
+# Request-scoped identity map: entities resolved from keys are remembered here
+# so that each key is fetched at most once per request. The app is threadsafe,
+# so every thread (request) has its own map, which is reset by the
+# BaseHandler at the start of each request.
+_identity_map = threading.local()
+
+
+def reset_identity_map():
+    '''Forget all entities resolved during the previous request.'''
+    _identity_map.entities = {}
+
+
+def _identity_entities():
+    entities = getattr(_identity_map, 'entities', None)
+    if entities is None:
+        entities = _identity_map.entities = {}
+    return entities
+
+
+def lookup_multi(keys):
+    '''Return the entities for a list of keys. Keys which have not already
+    been resolved in this request are fetched together with one get_multi.'''
+    entities = _identity_entities()
+    missing = list(set(k for k in keys if k is not None and k not in entities))
+    if missing:
+        for key, entity in zip(missing, ndb.get_multi(missing)):
+            entities[key] = entity
+    return [entities.get(key) if key is not None else None for key in keys]
+
+
+def lookup(key):
+    '''Return the entity for a single key using the identity map.'''
+    return lookup_multi([key])[0]
+
+
+def render_markdown(text):
+    '''Convert markdown text to html. Any raw html in the text is replaced.'''
+    import markdown
+    return markdown.markdown(
+        text,
+        output_format='html5',
+        safe_mode='replace',
+    )
+
+
+def newest_first_page(query, prop, limit, cursor=None, newer=False):
+    '''Return a page of query results ordered newest first by the date
+    property prop, with the cursors for the older and newer pages (None when
+    there are no more results in that direction).
+
+    The page starts just after cursor, or when newer is True, it ends just
+    before cursor. Every page costs the same however deep it is, unlike an
+    offset which reads and discards all the skipped entities.'''
+    if cursor is None:
+        items, end, more = query.order(-prop).fetch_page(limit)
+        return items, end if more else None, None
+    if not newer:
+        items, end, more = query.order(-prop).fetch_page(
+            limit, start_cursor=cursor)
+        return items, end if more else None, cursor
+    # read backwards from cursor to get the newer page
+    items, end, more = query.order(prop).fetch_page(
+        limit, start_cursor=cursor.reversed())
+    if not more:
+        # reached the newest results - show a full first page instead
+        return newest_first_page(query, prop, limit)
+    items.reverse()
+    return items, cursor, end.reversed()
+
+
+def prefetch(entities, *attrs):
+    '''Resolve the KeyProperty attributes named in attrs for every entity in
+    one get_multi, e.g. prefetch(photos, 'user', 'competition').
+
+    The resolved entities are attached to the request identity map, so later
+    calls such as lookup(photo.user) or lookup(photo.competition) cost no
+    further RPCs. Return the entities as a list.'''
+    entities = list(entities)
+    lookup_multi([
+        getattr(entity, attr) for entity in entities for attr in attrs
+    ])
+    return entities
+
 
 class User(ndb.Model):
     username = ndb.StringProperty(required=True)
@@ -23,47 +112,101 @@ class User(ndb.Model):
     verified = ndb.BooleanProperty(default=False)
     verify_code = ndb.StringProperty()
     admin = ndb.BooleanProperty(default=False)
+    # superseded by ResetToken, kept for existing entities
     pass_reset_code = ndb.StringProperty()
     pass_reset_expire = ndb.DateTimeProperty()
     bio = ndb.TextProperty(default='')
+    # the bio rendered as html by markdown
+    bio_html = ndb.TextProperty()
     extra_photo_count = ndb.IntegerProperty(default=0)
     login_count = ndb.IntegerProperty(default=0)
     logout_count = ndb.IntegerProperty(default=0)
+    # sessions carry the version they were issued for, increment it to revoke
+    # all the user's sessions
+    session_version = ndb.IntegerProperty(default=0, indexed=False)
+
+    # how long the session version of a user is cached in memcache (seconds)
+    SESSION_VERSION_TIME = 10 * 60
+
+    @staticmethod
+    def _session_version_key(user_id):
+        return 'session_version:%d' % user_id
+
+    @classmethod
+    def session_version_for(cls, user_id):
+        '''Return the current session version of a user, or None if there is
+        no such user. The version is cached in memcache.'''
+        key = cls._session_version_key(user_id)
+        version = memcache.get(key)
+        if version is None:
+            user = lookup(ndb.Key(cls, user_id))
+            if user is None:
+                return None
+            version = user.session_version
+            memcache.add(key, version, time=cls.SESSION_VERSION_TIME)
+        return version
+
+    def _post_put_hook(self, future):
+        # The next session check reads the version from the datastore. The
+        # delete locks out adds briefly, so that a check racing with this put
+        # (which may be part of a transaction that has not yet committed)
+        # cannot cache the old version.
+        memcache.delete(self._session_version_key(self.key.id()), seconds=5)
 
     @classmethod
     def user_from_name(cls, name):
         '''Return the user from the name attribute.'''
         logging.warning('Getting user object from username: %s' % repr(name))
-        query = cls.query(cls.username == name)
-        return query.get()
+        return UserName.user_for(name)
 
     @classmethod
     def user_from_email(cls, email):
         '''Return the user from the email attribute.'''
-        query = cls.query(cls.email == email)
-        return query.get()
+        return UserEmail.user_for(email)
 
     @classmethod
-    def user_from_reset_code(cls, reset_code):
-        query = cls.query(cls.pass_reset_code == reset_code)
-        return query.get()
+    def register(cls, username, email, **kwds):
+        '''Create a new user together with the UserName and UserEmail
+        entities which reserve the username and email address. Return None
+        if either of them is already taken.'''
+        user_id = cls.allocate_ids(1)[0]
+        user = cls(id=user_id, username=username, email=email, **kwds)
+        return cls._register(user)
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _register(user):
+        name_key = UserName.key_for(user.username)
+        email_key = UserEmail.key_for(user.email)
+        if any(ndb.get_multi([name_key, email_key])):
+            return None
+        ndb.put_multi([
+            user,
+            UserName(key=name_key, user=user.key),
+            UserEmail(key=email_key, user=user.key),
+        ])
+        return user
 
     def scoring_competitions(self):
         '''Return a list of competitions for which the user must submit
         scores.'''
         user_comps = UserComp.query().filter(UserComp.user == self.key)
-        for user_comp in user_comps:
-            if not user_comp.submitted_scores:
-                comp = user_comp.comp.get()
-                if comp.status == SCORING:
-                    yield comp
+        comp_keys = [uc.comp for uc in user_comps if not uc.submitted_scores]
+        for comp in lookup_multi(comp_keys):
+            if comp.status == SCORING:
+                yield comp
+
+    def set_bio(self, bio):
+        '''Set the bio text and store its rendered html.'''
+        self.bio = bio
+        self.bio_html = render_markdown(bio if bio else "*...no details...*")
 
     def bio_markdown(self):
-        return markdown.markdown(
-            self.bio if self.bio else "*...no details...*",
-            output_format='html5',
-            safe_mode='replace',
-        )
+        if self.bio_html is None:
+            return render_markdown(
+                self.bio if self.bio else "*...no details...*"
+            )
+        return self.bio_html
 
     def __eq__(self, other):
         '''Compare to users for equality.'''
@@ -77,6 +220,71 @@ class User(ndb.Model):
         return self.__str__()
 
 
+class UserValue(ndb.Model):
+    '''Reserves a unique value of a user, such as the username. The id is
+    the value. Subclasses set USER_PROPERTY to the User property holding it.'''
+    user = ndb.KeyProperty(kind=User, required=True, indexed=False)
+
+    USER_PROPERTY = None
+
+    @classmethod
+    def key_for(cls, value):
+        return ndb.Key(cls, value)
+
+    @classmethod
+    def user_for(cls, value):
+        '''Return the user with this value, or None.'''
+        if not value:
+            return None
+        marker = cls.key_for(value).get()
+        if marker:
+            return marker.user.get()
+        # users registered before these entities existed have no marker yet
+        # (until /help/user-index has run), so find them by query and add it
+        user = User.query(cls.USER_PROPERTY == value).get()
+        if user:
+            logging.info('creating %s marker for %s', cls.__name__, user)
+            cls(key=cls.key_for(value), user=user.key).put()
+        return user
+
+
+class UserName(UserValue):
+    '''Reserves a username. The id is the username.'''
+    USER_PROPERTY = User.username
+
+
+class UserEmail(UserValue):
+    '''Reserves an email address. The id is the email address.'''
+    USER_PROPERTY = User.email
+
+
+class ResetToken(ndb.Model):
+    '''A password reset code sent to a user. The id is the code.'''
+    user = ndb.KeyProperty(kind=User, required=True, indexed=False)
+    expires = ndb.DateTimeProperty(required=True, indexed=False)
+
+    def expired(self):
+        return self.expires < datetime.datetime.now()
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def use(cls, code, password):
+        '''Set a new (hashed) password for the user of a reset code and
+        delete the code. Return the user, or None if the code is not valid.'''
+        token = cls.get_by_id(code)
+        if not token or token.expired():
+            return None
+        user = token.user.get()
+        if not user:
+            return None
+        user.password = password
+        # sign out every existing session of the user
+        user.session_version += 1
+        user.put()
+        token.key.delete()
+        return user
+
+
 class Competition(ndb.Model):
     title = ndb.StringProperty(required=True)
     description = ndb.TextProperty()
@@ -88,6 +296,9 @@ class Competition(ndb.Model):
     finished = ndb.BooleanProperty(default=False)
     status = ndb.IntegerProperty(default=0)
     challenge = ndb.BooleanProperty(default=False)
+    # set while the competition is being deleted by the task queue
+    deleting = ndb.BooleanProperty(default=False)
+    deleted_count = ndb.IntegerProperty(default=0)
 
     @classmethod
     def all(cls):
@@ -96,6 +307,19 @@ class Competition(ndb.Model):
         query = query.order(-Competition.start)
         return query
 
+    @classmethod
+    def years(cls):
+        '''Return the years in which competitions were held, newest first.'''
+        query = cls.query(projection=[cls.year], distinct=True)
+        return sorted((comp.year for comp in query), reverse=True)
+
+    @classmethod
+    def by_year(cls, year):
+        '''Return the competitions held in a year, newest first.'''
+        comps = cls.query(cls.year == year).fetch()
+        comps.sort(key=lambda comp: comp.start, reverse=True)
+        return comps
+
     @classmethod
     def get_by_title_date(cls, title, month, year):
         '''Return competition based on title, month and year.'''
@@ -138,26 +362,64 @@ class Competition(ndb.Model):
         '''Return the month as a string name.'''
         return MONTHS[self.month]
 
-    #@ndb.transactional(xg=True)
-    def delete(self):
-        '''Delete a competition.
+    def update_photo_status(self):
+        '''Copy the competition status onto all the photos entered into the
+        competition.'''
+        keys = Photo.query(Photo.competition == self.key).fetch(keys_only=True)
+        # get by key so that recent writes to the photos are not lost
+        photos = ndb.get_multi(keys)
+        for photo in photos:
+            photo.comp_status = self.status
+        ndb.put_multi(photos)
+        return photos
+
+    def delete_chunk(self, stage, cursor=None):
+        '''Delete the next chunk of the competition's entities.
 
-        Items to delete UserComps, Photos, Comments, Scores
+        The competition is deleted in stages (see DELETE_STAGES): photos,
+        with their comments, scores and blobs, then UserComps, then Ballots
+        and finally the CompetitionStats and the competition itself. Each call
+        deletes at most DELETE_CHUNK entities of a stage's main kind.
+
+        Return (stage, cursor, count) where stage and cursor are where the
+        next call should continue from - stage is None once everything has
+        been deleted - and count is the number of entities deleted.
         '''
-        all_keys = []
-        for usercomp in self.users():
-            all_keys.append(usercomp.key)
-        for photo in Photo.competition_photos(self):
-            all_keys.append(photo.key)
-            for comment in photo.comments():
-                all_keys.append(comment.key)
-            for score in photo.scores():
-                all_keys.append(score.key)
-            blobstore.delete(photo.blob)
-        all_keys.append(self.key)
+        more = False
+        if stage == 'photos':
+            query = Photo.query(Photo.competition == self.key)
+            photos, cursor, more = query.fetch_page(
+                DELETE_CHUNK, start_cursor=cursor)
+            futures = []
+            for photo in photos:
+                futures.append(photo.comments().fetch_async(keys_only=True))
+                futures.append(photo.scores().fetch_async(keys_only=True))
+            keys = [photo.key for photo in photos]
+            for future in futures:
+                keys.extend(future.get_result())
+            if photos:
+                from google.appengine.ext import blobstore
+                blobstore.delete([photo.blob for photo in photos])
+            if photos and self.status == COMPLETED:
+                Showcase.remove_photos([photo.key.id() for photo in photos])
+        elif stage == 'usercomps':
+            keys, cursor, more = self.users().fetch_page(
+                DELETE_CHUNK, start_cursor=cursor, keys_only=True)
+        elif stage == 'ballots':
+            keys, cursor, more = Ballot.competition_ballots(self).fetch_page(
+                DELETE_CHUNK, start_cursor=cursor, keys_only=True)
+        else:
+            keys = [CompetitionStats.key_for(self.key), self.key]
 
-        logging.info(all_keys)
-        ndb.delete_multi(all_keys)
+        logging.info('delete %s, %s: %d entities', self, stage, len(keys))
+        ndb.delete_multi(keys)
+
+        if more and cursor:
+            return stage, cursor, len(keys)
+        next_stage = DELETE_STAGES.index(stage) + 1
+        if next_stage == len(DELETE_STAGES):
+            return None, None, len(keys)
+        return DELETE_STAGES[next_stage], None, len(keys)
 
     def __eq__(self, other):
         '''Compare competitions for equality.'''
@@ -185,22 +447,115 @@ class UserComp(ndb.Model):
     When a user submits a photo to a competition a record is added to this
     class. This class is used to tell if a user can submit scores to a
     competition - only when they have submitted photo to competition. And if
-    they have submitted scores during the scoring phase of the competition.'''
+    they have submitted scores during the scoring phase of the competition.
+
+    The key name is "user_id:comp_id" so that a UserComp can be read by key
+    rather than by an (eventually consistent) query.'''
     user = ndb.KeyProperty(kind=User, required=True)
     comp = ndb.KeyProperty(kind=Competition, required=True)
+    # the photo the user entered into the competition
+    photo = ndb.KeyProperty(kind='Photo')
     submitted_scores = ndb.BooleanProperty(default=False)
 
+    @classmethod
+    def key_for(cls, user_key, comp_key):
+        '''Return the key of the UserComp for a user and competition.'''
+        return ndb.Key(cls, '%d:%d' % (user_key.id(), comp_key.id()))
+
+    @classmethod
+    def entered_comp_ids(cls, user_key):
+        '''Return the set of ids of the competitions a user has entered. The
+        comp id is part of the key name, so one keys-only query is enough.
+        UserComps which have not been rekeyed yet (they have integer ids) are
+        read to find their competition.'''
+        keys = cls.query(cls.user == user_key).fetch(keys_only=True)
+        comp_ids = set()
+        old_keys = []
+        for key in keys:
+            if isinstance(key.id(), basestring):
+                comp_ids.add(int(key.id().split(':')[1]))
+            else:
+                old_keys.append(key)
+        for usercomp in ndb.get_multi(old_keys):
+            if usercomp:
+                comp_ids.add(usercomp.comp.id())
+        return comp_ids
+
     @classmethod
     def get_usercomp(cls, user, comp):
         '''Return details about a user's participation in a competition.'''
-        query = cls.query(cls.user == user.key, cls.comp == comp.key)
-        return query.get()
+        return cls.key_for(user.key, comp.key).get()
 
     @classmethod
-    def all_scores_submitted(cls, comp):
-        '''Have all scores been submitted for a competition.'''
-        query = cls.query(cls.comp == comp.key)
-        return all(r.submitted_scores for r in query)
+    @ndb.transactional(xg=True)
+    def submit_scores(cls, key, username, scores):
+        '''Store a user's ballot - a dict of photo id: score - record that
+        the user has submitted scores, and add the scores to the competition's
+        running totals, all in one transaction.
+        Return False if the user has already submitted scores.'''
+        usercomp = key.get()
+        if usercomp.submitted_scores:
+            return False
+        stats = CompetitionStats.get_for(usercomp.comp)
+        stats.add_ballot(scores)
+        photo_ids = sorted(scores)
+        ballot = Ballot(
+            key=Ballot.key_for(usercomp.user, usercomp.comp),
+            user=usercomp.user,
+            comp=usercomp.comp,
+            username=username,
+            photos=photo_ids,
+            scores=[scores[photo_id] for photo_id in photo_ids]
+        )
+        usercomp.submitted_scores = True
+        entities = [ballot, usercomp, stats]
+        pending = UserPending.done(usercomp.user, usercomp.comp, 'need_scores')
+        if pending:
+            entities.append(pending)
+        ndb.put_multi(entities)
+        return True
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def add_entry(cls, user_key, photo):
+        '''Create the UserComp for a competition photograph and count the
+        entry in the competition's stats, in one transaction.
+        Return None, without writing anything, if the user has already
+        entered a photograph into the competition.'''
+        key = cls.key_for(user_key, photo.competition)
+        if key.get():
+            return None
+        stats = CompetitionStats.get_for(photo.competition)
+        stats.photo_count += 1
+        stats.participants += 1
+        usercomp = cls(
+            key=key,
+            user=user_key,
+            comp=photo.competition,
+            photo=photo.key
+        )
+        entities = [usercomp, stats]
+        pending = UserPending.done(user_key, photo.competition, 'need_photos')
+        if pending:
+            entities.append(pending)
+        ndb.put_multi(entities)
+        return usercomp
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def remove_entry(cls, key):
+        '''Delete a UserComp and remove its entry from the competition's
+        stats, in one transaction.'''
+        usercomp = key.get()
+        if not usercomp:
+            return
+        stats = CompetitionStats.get_for(usercomp.comp)
+        stats.photo_count = max(stats.photo_count - 1, 0)
+        stats.participants = max(stats.participants - 1, 0)
+        stats.put()
+        key.delete()
+        # the competition needs a photograph from the user again
+        UserPending.key_for(usercomp.user).delete()
 
     def __str__(self):
         return 'UserComp({}, {})'.format(self.comp.get(), self.user.get())
@@ -209,8 +564,13 @@ class UserComp(ndb.Model):
 class Photo(ndb.Model):
     user = ndb.KeyProperty(kind=User, required=True)
     competition = ndb.KeyProperty(kind=Competition, default=None)  # required=True)
+    # denormalized copies of user.username and competition.status
+    username = ndb.StringProperty()
+    comp_status = ndb.IntegerProperty()
     title = ndb.StringProperty()
     blob = ndb.BlobKeyProperty(required=True)
+    # the base image serving url for the blob - sizes are appended to this
+    serving_url = ndb.StringProperty(indexed=False)
     upload_date = ndb.DateTimeProperty(auto_now_add=True)
     position = ndb.IntegerProperty(default=0)
     total_score = ndb.IntegerProperty(default=0)
@@ -240,12 +600,11 @@ class Photo(ndb.Model):
     @classmethod
     def user_photos_complete(cls, user, limit=None):
         '''Return all photos of a user in completed competitions.'''
-        query = cls.query(cls.user == user.key)
-        query = query.filter(cls.competition != None)
-        photos = []
-        for photo in query:
-            if photo.competition.get().status == COMPLETED:
-                photos.append(photo)
+        query = cls.query(
+            cls.user == user.key,
+            cls.comp_status == COMPLETED,
+        )
+        photos = prefetch(query, 'competition')
         photos.sort(key=lambda p: p.upload_date)
         return photos
 
@@ -259,10 +618,19 @@ class Photo(ndb.Model):
     @classmethod
     def competition_result(cls, competition):
         '''Return all photos entered in a competition and order by total score
-        descending.'''
+        descending.
+
+        Once the scores have been calculated the photos are read by key, in
+        the order stored in the CompetitionStats, so the result is never
+        stale. Competitions completed before the order was stored use a
+        query.'''
+        stats = CompetitionStats.key_for(competition.key).get()
+        if stats and stats.results:
+            photos = ndb.get_multi([ndb.Key(cls, i) for i in stats.results])
+            return [photo for photo in photos if photo]
         query = cls.query(cls.competition == competition.key)
         query = query.order(-cls.total_score)
-        return query
+        return query.fetch()
 
     @classmethod
     def extra_photos(cls, user):
@@ -274,24 +642,14 @@ class Photo(ndb.Model):
         query = query.order(cls.month, cls.upload_date)
         return query
 
-    @classmethod
-    def competition_user(cls, competition, user):
-        '''Return the photo entered by user into competition.'''
-        query = cls.query(
-            cls.competition == competition.key,
-            cls.user == user.key,
-        )
-        return query.get()
-
     def commentators(self):
         '''Return a list of all the commentators and photographer (User
         instances) for a particular photo.'''
-        commentators = [self.user.get()]
+        user_keys = [self.user]
         for comment in Comment.query(Comment.photo == self.key):
-            user = comment.user.get()
-            if user not in commentators:
-                commentators.append(user)
-        return commentators
+            if comment.user not in user_keys:
+                user_keys.append(comment.user)
+        return lookup_multi(user_keys)
 
     def scores(self):
         '''Return a collection of all the scores for this photo as Scores
@@ -302,19 +660,28 @@ class Photo(ndb.Model):
     def data(self, size=211):
         '''Return information about photo and urls for image and thumb.'''
         title = self.title if self.title else 'Untitled'
-        url = get_serving_url(self.blob, size=MAX_SIZE)
-        thumb = get_serving_url(self.blob, size=size, crop=True)
+        url = self.url()
+        thumb = self.thumb(size)
         date = self.upload_date.strftime('%d %B, %Y')
         position = self.position if self.position is not None else ''
         score = self.total_score if position != '' else ''
-        comp_title = self.competition.get().title
+        comp_title = lookup(self.competition).title
         return title, url, thumb, date, position, score, comp_title
 
     def thumb(self, size=211):
-        return get_serving_url(self.blob, size=size, crop=True)
+        return self._image_url(size, crop=True)
 
     def url(self, size=MAX_SIZE):
-        return get_serving_url(self.blob, size=size)
+        return self._image_url(size)
+
+    def _image_url(self, size, crop=False):
+        '''Return the url for the image at a particular size, built from the
+        stored serving url.'''
+        if not self.serving_url:
+            # photos uploaded before the serving url was stored
+            from google.appengine.api.images import get_serving_url
+            return get_serving_url(self.blob, size=size, crop=crop)
+        return '%s=s%d%s' % (self.serving_url, size, '-c' if crop else '')
 
     def exif(self):
         return {
@@ -340,11 +707,8 @@ class Photo(ndb.Model):
     def ordinal_position(self):
         return ordinal(self.position)
 
-    def username(self):
-        return self.user.get().username
-
     def get_competition(self):
-        return self.competition.get()
+        return lookup(self.competition)
 
     def comments(self):
         query = Comment.query(Comment.photo == self.key)
@@ -371,11 +735,8 @@ class Photo(ndb.Model):
         '''
         all_keys = []
         if self.competition:
-            user_comp = UserComp.query(
-                UserComp.user == self.user,
-                UserComp.comp == self.competition
-            ).get()
-            all_keys.append(user_comp.key)
+            UserComp.remove_entry(
+                UserComp.key_for(self.user, self.competition))
         else:
             user = self.user.get()
             user.extra_photo_count -= 1
@@ -387,8 +748,11 @@ class Photo(ndb.Model):
                 Scores.photo == self.key).fetch(keys_only=True):
             all_keys.append(score_key)
         all_keys.append(self.key)
+        from google.appengine.ext import blobstore
         blobstore.delete(self.blob)
         ndb.delete_multi(all_keys)
+        if self.comp_status == COMPLETED:
+            Showcase.remove_photos([self.key.id()])
 
     def delete_comments(self):
         '''Delete comments associated with this photo.'''
@@ -409,8 +773,11 @@ class Photo(ndb.Model):
 class Comment(ndb.Model):
     photo = ndb.KeyProperty(kind=Photo, required=True)
     user = ndb.KeyProperty(kind=User, required=True)
+    username = ndb.StringProperty()
     submit_date = ndb.DateTimeProperty(auto_now_add=True)
     text = ndb.TextProperty()
+    # the text rendered as html by markdown
+    html = ndb.TextProperty()
 
     @classmethod
     def photo_comments(cls, photo):
@@ -418,15 +785,10 @@ class Comment(ndb.Model):
         query = cls.query(cls.photo == photo.key)
         query = query.order(cls.submit_date)
         for comment in query:
-            text = markdown.markdown(
-                comment.text,
-                output_format='html5',
-                safe_mode='replace',
-            )
             yield (
                 comment.key.id(),
-                text,
-                comment.user.get().username,
+                comment.markdown(),
+                comment.username,
                 comment.user.id(),
                 comment.format_date()
             )
@@ -439,30 +801,30 @@ class Comment(ndb.Model):
         return query
 
     @classmethod
-    def recent_comments(cls, limit=5, offset=0):
-        '''Return the most recent comments up to a certain limit.'''
-        query = cls.query()
-        query = query.order(-cls.submit_date)
-        return query.fetch(limit, offset=offset)
-
-    def username(self):
-        return self.user.get().username
+    def recent_comments(cls, limit=5, cursor=None, newer=False):
+        '''Return the most recent comments up to a certain limit, and the
+        cursors for the older and newer pages of comments.'''
+        comments, older, newer = newest_first_page(
+            cls.query(), cls.submit_date, limit, cursor, newer)
+        return prefetch(comments, 'photo'), older, newer
+
+    def set_text(self, text):
+        '''Set the comment text and store its rendered html.'''
+        self.text = text
+        self.html = render_markdown(text)
 
     def markdown(self):
-        '''Apply markdown to the comment text.'''
-        text = markdown.markdown(
-            self.text,
-            output_format='html5',
-            safe_mode='replace',
-        )
-        return text
+        '''Return the comment text with markdown applied.'''
+        if self.html is None:
+            return render_markdown(self.text)
+        return self.html
 
     def format_date(self):
         '''Format the stored submit date for pretty printing.'''
         return self.submit_date.strftime('%H:%M, %d-%b-%Y')
 
     def photo_thumbnail(self):
-        return self.photo.get().thumb(42)
+        return lookup(self.photo).thumb(42)
 
     def photo_id(self):
         return self.photo.id()
@@ -470,9 +832,12 @@ class Comment(ndb.Model):
 
 class Note(ndb.Model):
     user = ndb.KeyProperty(kind=User, required=True)
+    username = ndb.StringProperty()
     submit_date = ndb.DateTimeProperty(auto_now_add=True)
     title = ndb.StringProperty()
     text = ndb.TextProperty()
+    # the text rendered as html by markdown
+    html = ndb.TextProperty()
 
     @classmethod
     def user_notes(cls, user):
@@ -481,60 +846,289 @@ class Note(ndb.Model):
         return query
 
     @classmethod
-    def recent_notes(cls, limit=4, offset=0):
-        query = cls.query()
-        query = query.order(-cls.submit_date)
-        for note in query.fetch(limit, offset=offset):
-            text = markdown.markdown(
-                note.text,
-                output_format='html5',
-                safe_mode='replace',
-            )
-            yield (
-                note.key.id(),
-                note.title,
-                text,
-                note.user.get().username,
-                note.user.id(),
-                note.format_date()
-            )
+    def recent_notes(cls, limit=4, cursor=None, newer=False):
+        '''Return the most recent notes up to a certain limit, and the
+        cursors for the older and newer pages of notes.'''
+        notes, older, newer = newest_first_page(
+            cls.query(), cls.submit_date, limit, cursor, newer)
+        notes = [(
+            note.key.id(),
+            note.title,
+            note.markdown(),
+            note.username,
+            note.user.id(),
+            note.format_date()
+        ) for note in notes]
+        return notes, older, newer
 
     def format_date(self):
         '''Format the stored submit date for pretty printing.'''
         return self.submit_date.strftime('%H:%M, %d-%b-%Y')
 
+    def set_text(self, text):
+        '''Set the note text and store its rendered html.'''
+        self.text = text
+        self.html = render_markdown(text)
+
     def markdown(self):
-        '''Apply markdown to the note text.'''
-        text = markdown.markdown(
-            self.text,
-            output_format='html5',
-            safe_mode='replace',
-        )
-        return text
+        '''Return the note text with markdown applied.'''
+        if self.html is None:
+            return render_markdown(self.text)
+        return self.html
 
 
 class Scores(ndb.Model):
+    '''The score given to a photo by a user. A Scores entity is a child of
+    the scoring user's UserComp and its id is the photo id, so each score has
+    a known key.
+
+    Scores have been replaced by Ballots. This model remains so that old
+    scores can be migrated and deleted.'''
     photo = ndb.KeyProperty(kind=Photo, required=True)
     user_from = ndb.KeyProperty(kind=User, required=True)
+    # username of user_from
+    username = ndb.StringProperty()
     score = ndb.IntegerProperty(required=True)
 
     @classmethod
-    def photo_score(cls, photo):
-        '''Return the total score for a photo.'''
-        query = cls.query(cls.photo == photo.key)
-        #scores = [s.score for s in query]
-        #logging.info(scores)
-        #return sum(scores)
-        return sum(s.score for s in query)
+    def key_for(cls, photo, user_key):
+        '''Return the key of the score given to a photo by a user.'''
+        parent = UserComp.key_for(user_key, photo.competition)
+        return ndb.Key(cls, photo.key.id(), parent=parent)
+
+
+class UserPending(ndb.Model):
+    '''The competitions which are waiting for a user to submit a photograph
+    or scores. The id is the user id.
+
+    The record is built from the competitions the first time it is needed,
+    then kept up to date as the user uploads photographs and submits scores.
+    Changes to the competitions themselves (new competitions, status changes
+    and deletions) bump the competitions cache generation, and a record
+    built for an older generation is rebuilt.
+    '''
+    need_photos = ndb.KeyProperty(kind=Competition, repeated=True, indexed=False)
+    need_scores = ndb.KeyProperty(kind=Competition, repeated=True, indexed=False)
+    # the competitions cache generation the record was built for
+    generation = ndb.IntegerProperty(indexed=False)
 
     @classmethod
-    def score_from_user(cls, photo, user):
-        '''Return the score submitted by a user for a particular photo.'''
-        query = cls.query(
-            cls.photo == photo.key,
-            cls.user_from == user.key
+    def key_for(cls, user_key):
+        return ndb.Key(cls, user_key.id())
+
+    @classmethod
+    def get_for(cls, user_key, generation):
+        '''Return the pending record for a user, rebuilding it if it is
+        missing or was built for an older generation.'''
+        pending = cls.key_for(user_key).get()
+        if pending is None or pending.generation != generation:
+            pending = cls.build(user_key, generation)
+        return pending
+
+    @classmethod
+    def build(cls, user_key, generation):
+        '''Find the competitions waiting for the user and store them.'''
+        open_comps = Competition.get_by_status(OPEN).fetch(keys_only=True)
+        scoring_comps = Competition.get_by_status(SCORING).fetch(keys_only=True)
+        usercomps = ndb.get_multi(
+            [UserComp.key_for(user_key, comp) for comp in open_comps]
+            + [UserComp.key_for(user_key, comp) for comp in scoring_comps]
         )
-        return query.get()
+        entered_open = usercomps[:len(open_comps)]
+        entered_scoring = usercomps[len(open_comps):]
+        pending = cls(
+            key=cls.key_for(user_key),
+            need_photos=[
+                comp for comp, usercomp in zip(open_comps, entered_open)
+                if not usercomp
+            ],
+            need_scores=[
+                comp for comp, usercomp in zip(scoring_comps, entered_scoring)
+                if usercomp and not usercomp.submitted_scores
+            ],
+            generation=generation
+        )
+        pending.put()
+        return pending
+
+    @classmethod
+    def done(cls, user_key, comp_key, attr):
+        '''Remove a competition from one of the lists (need_photos or
+        need_scores) of a user's record, if it exists. Can be called inside
+        the transaction which does the work.'''
+        pending = cls.key_for(user_key).get()
+        if pending is None:
+            return None
+        comps = getattr(pending, attr)
+        if comp_key in comps:
+            setattr(pending, attr, [comp for comp in comps if comp != comp_key])
+        return pending
+
+
+class Ballot(ndb.Model):
+    '''All the scores given by a user to the photos in a competition, stored
+    as two parallel lists in one entity. The key name is the same as the
+    user's UserComp: "user_id:comp_id".'''
+    user = ndb.KeyProperty(kind=User, required=True)
+    comp = ndb.KeyProperty(kind=Competition, required=True)
+    username = ndb.StringProperty(indexed=False)
+    photos = ndb.IntegerProperty(repeated=True, indexed=False)
+    scores = ndb.IntegerProperty(repeated=True, indexed=False)
+
+    @classmethod
+    def key_for(cls, user_key, comp_key):
+        '''Return the key of the ballot of a user for a competition.'''
+        return ndb.Key(cls, '%d:%d' % (user_key.id(), comp_key.id()))
+
+    @classmethod
+    def competition_ballots(cls, comp):
+        '''Return all the ballots submitted for a competition.'''
+        return cls.query(cls.comp == comp.key)
+
+    def photo_scores(self):
+        '''Return a dict of photo id: score.'''
+        return dict(zip(self.photos, self.scores))
+
+
+class CompetitionStats(ndb.Model):
+    '''Running aggregates for a competition which are updated as photographs
+    are entered and deleted and as each ballot is submitted. The id is the
+    competition id.'''
+    # photo id (as a str) -> total score from the ballots submitted so far
+    totals = ndb.JsonProperty(indexed=False)
+    # the number of ballots submitted
+    ballots = ndb.IntegerProperty(default=0)
+    # the number of photographs entered
+    photo_count = ndb.IntegerProperty(default=0)
+    # the number of users who have entered (the number of UserComps)
+    participants = ndb.IntegerProperty(default=0)
+    # the photo ids in finishing order, stored when the scores are calculated
+    results = ndb.IntegerProperty(repeated=True, indexed=False)
+
+    @classmethod
+    def key_for(cls, comp_key):
+        return ndb.Key(cls, comp_key.id())
+
+    @classmethod
+    def get_for(cls, comp_key):
+        '''Return the stats for a competition, a new entity if none exist.'''
+        key = cls.key_for(comp_key)
+        return key.get() or cls(key=key)
+
+    def add_ballot(self, scores):
+        '''Add a ballot - a dict of photo id: score - to the totals.'''
+        totals = dict(self.totals or {})
+        for photo_id, score in scores.iteritems():
+            totals[str(photo_id)] = totals.get(str(photo_id), 0) + score
+        self.totals = totals
+        self.ballots += 1
+
+    def photo_total(self, photo_key):
+        '''Return the total score so far for a photo.'''
+        return (self.totals or {}).get(str(photo_key.id()), 0)
+
+    @classmethod
+    def reconcile(cls, comp):
+        '''Recalculate the running totals and counts from the Ballots, Photos
+        and UserComps, in case they have drifted, and return the corrected
+        stats.
+
+        The recount happens outside a transaction (it needs queries), so it
+        is only stored if the stats have not changed meanwhile; otherwise a
+        ballot or entry which committed during the recount would be lost.
+        '''
+        key = cls.key_for(comp.key)
+        for _ in range(3):
+            current = key.get()
+            stats = cls._recount(comp)
+            # the finishing order is not recounted
+            stats.results = current.results if current else []
+            if cls._replace(key, cls._counts(current), stats):
+                logging.info('reconciled %s: %s', comp, stats)
+                return stats
+        logging.warning('could not reconcile %s, stats keep changing', comp)
+        return key.get() or cls(key=key)
+
+    @classmethod
+    def _recount(cls, comp):
+        usercomp_keys = comp.users().fetch(keys_only=True)
+        # each user's ballot has the same key name as their UserComp, so the
+        # ballots are read with a (strongly consistent) get
+        ballots = ndb.get_multi(
+            [ndb.Key(Ballot, key.id()) for key in usercomp_keys])
+        stats = cls(key=cls.key_for(comp.key))
+        for ballot in ballots:
+            if ballot:
+                stats.add_ballot(ballot.photo_scores())
+        stats.photo_count = Photo.query(Photo.competition == comp.key).count()
+        stats.participants = len(usercomp_keys)
+        return stats
+
+    @staticmethod
+    def _counts(stats):
+        if stats is None:
+            return (0, 0, 0)
+        return (stats.ballots, stats.photo_count, stats.participants)
+
+    @classmethod
+    @ndb.transactional
+    def _replace(cls, key, counts, stats):
+        '''Store the stats if the stored counts are still the same.'''
+        if cls._counts(key.get()) != counts:
+            return False
+        stats.put()
+        return True
+
+
+class Showcase(ndb.Model):
+    '''The pool of photos from completed competitions which can be displayed
+    on the home page. There is only one Showcase entity. Each item in photos
+    is a list: [photo id, image url, title, username].'''
+    photos = ndb.JsonProperty(indexed=False)
+
+    KEY_NAME = 'showcase'
+
+    @staticmethod
+    def photo_item(photo):
+        '''Return the showcase item for a photo.'''
+        title = photo.title if photo.title else 'Untitled'
+        return [photo.key.id(), photo.url(), title, photo.username]
+
+    @classmethod
+    def get_pool(cls):
+        return cls.get_or_insert(cls.KEY_NAME)
+
+    @classmethod
+    @ndb.transactional
+    def add_photos(cls, photos):
+        '''Add photos (from a competition which has just been completed) to
+        the pool.'''
+        pool = cls.get_pool()
+        items = list(pool.photos or [])
+        ids = set(item[0] for item in items)
+        for photo in photos:
+            if photo.key.id() not in ids:
+                items.append(cls.photo_item(photo))
+        pool.photos = items
+        pool.put()
+
+    @classmethod
+    @ndb.transactional
+    def remove_photos(cls, photo_ids):
+        '''Remove deleted photos from the pool.'''
+        photo_ids = set(photo_ids)
+        pool = cls.get_pool()
+        pool.photos = [i for i in pool.photos or [] if i[0] not in photo_ids]
+        pool.put()
+
+    @classmethod
+    def rebuild(cls):
+        '''Recreate the pool from all photos in completed competitions.'''
+        query = Photo.query(Photo.comp_status == COMPLETED)
+        pool = cls(id=cls.KEY_NAME)
+        pool.photos = [cls.photo_item(photo) for photo in query]
+        pool.put()
+        return pool
 
 
 # some functions that don't really fit in any particular model
@@ -550,19 +1144,24 @@ def user_scores(user):
 def csv_scores(comp):
     '''Create a csv file for all the scores for a competition.'''
     photos = list(Photo.competition_photos(comp))
-    photos.sort(key=lambda p: p.user.get().username.lower())
+    photos.sort(key=lambda p: p.username.lower())
+    ballots = [
+        (ballot.username, ballot.photo_scores())
+        for ballot in Ballot.competition_ballots(comp)
+    ]
 
     buf = StringIO.StringIO()
-    fieldnames = ['Recipient'] + [p.user.get().username for p in photos]
+    fieldnames = ['Recipient'] + [p.username for p in photos]
     data = csv.DictWriter(buf, fieldnames=fieldnames)
 
     data.writerow(dict((n, n) for n in fieldnames))
 
     for photo in photos:
         row = {}
-        row['Recipient'] = photo.user.get().username
-        for score in photo.scores():
-            row[score.user_from.get().username] = score.score
+        row['Recipient'] = photo.username
+        for username, photo_scores in ballots:
+            if photo.key.id() in photo_scores:
+                row[username] = photo_scores[photo.key.id()]
         data.writerow(row)
 
     return buf.getvalue()
@@ -580,10 +1179,10 @@ def csv_photos():
     buf = StringIO.StringIO()
     data = csv.writer(buf)
     data.writerow(fieldnames)
-    for photo in Photo.query():
+    for photo in prefetch(Photo.query(), 'competition'):
         data.writerow([
-            photo.key.id(), photo.user.get().username,
-            photo.competition.get().title if photo.competition else '',
+            photo.key.id(), photo.username,
+            lookup(photo.competition).title if photo.competition else '',
             photo.title, photo.upload_date,
             photo.position, photo.total_score, photo.make, photo.model,
             photo.datetime, photo.iso, photo.focal_length, photo.lens,
@@ -599,9 +1198,10 @@ def recently_completed_competitions():
     comps = comps.order(-Competition.start)
     for comp in comps.fetch(2):
         logging.info('recently_completed_competitions comp: %s', comp)
-        # only the top three results
+        # only the top three results, read by key once the scores have been
+        # calculated so they are never missing or stale
         photos = list(
-            photo for photo in Photo.competition_photos(comp)
+            photo for photo in Photo.competition_result(comp)
             if photo.position <= 3
         )
         results.append((comp, photos))
@@ -622,6 +1222,7 @@ def blob_exif(blob_key):
         ('aperture', ['ApertureValue', 'MaxApertureValue'], 0.0),
         ('copyright', 'Copyright', '')
     )
+    from google.appengine.api.images import Image
     data = {}
     im = Image(blob_key=blob_key)
     im.rotate(0)
@@ -687,6 +1288,9 @@ class UserStats(ndb.Model):
     most_second_place = ndb.IntegerProperty(default=0)
     most_third_place = ndb.IntegerProperty(default=0)
 
+    def username(self):
+        return lookup(self.user).username
+
     @classmethod
     def delete_all(cls):
         data = cls.query().fetch(keys_only=True)
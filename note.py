@@ -1,9 +1,9 @@
 #!/usr/bin/env python
 
-import webapp2
 import logging
 import datetime
 
+import cache
 from handler import BaseHandler
 from model import Note
 
@@ -18,36 +18,23 @@ def empty_note():
 
 class Notes(BaseHandler):
     def get(self):
-        user_id, user = self.get_user()
-
-        start = self.request.get('start')
-        logging.info('start: %s', start)
-
-        if not start:
-            start = 0
-        else:
-            start = int(start)
-            if start > 1000000:
-                start = 0
+        user = self.get_session()
+        user_id = user.id if user else None
 
-        if start == 0:
-            before = 0
-            after = 10
-        else:
-            before = start - 10
-            after = start + 10
+        cursor = self.get_cursor()
+        newer = cursor is not None and self.request.get('newer') == '1'
 
-        notes = list(Note.recent_notes(10, start))
-        more_old = '' if len(notes) == 10 else 'disabled'
-        more_new = '' if start > 0 else 'disabled'
+        notes, older, newer = Note.recent_notes(10, cursor, newer)
+        more_old = '' if older else 'disabled'
+        more_new = '' if newer else 'disabled'
 
         data = {
             'page_title': 'Notes',
             'user': user,
             'user_id': user_id,
             'notes': notes,
-            'before': before,
-            'after': after,
+            'before': newer.urlsafe() if newer else '',
+            'after': older.urlsafe() if older else '',
             'more_old': more_old,
             'more_new': more_new,
         }
@@ -98,11 +85,13 @@ class NoteNew(BaseHandler):
 
         new_note = Note(
             user=user.key,
+            username=user.username,
             submit_date=dt,
             title=title,
-            text=text,
         )
+        new_note.set_text(text)
         new_note.put()
+        cache.bump(cache.NOTES)
 
         self.redirect('/notes')
 
@@ -180,8 +169,9 @@ class NoteEdit(NoteChange):
             return
 
         note.title = title
-        note.text = text
+        note.set_text(text)
         note.put()
+        cache.bump(cache.NOTES)
 
         self.redirect('/notes')
 
@@ -223,14 +213,6 @@ class NoteDelete(NoteChange):
             return
 
         note.key.delete()
+        cache.bump(cache.NOTES)
 
         self.redirect('/notes')
-
-
-routes = [
-    (r'/notes', Notes),
-    (r'/note/edit/(\d+)', NoteEdit),
-    (r'/note/delete/(\d+)', NoteDelete),
-    (r'/note/new', NoteNew),
-]
-app = webapp2.WSGIApplication(routes=routes, debug=True)
@@ -2,11 +2,10 @@
 
 '''Photos: viewing, deleting and exporting data from the model.'''
 
-import webapp2
 import logging
-from google.appengine.api import mail
 from google.appengine.runtime.apiproxy_errors import OverQuotaError
 
+import cache
 from handler import BaseHandler
 from helper import OPEN, COMPLETED
 from model import Photo, Comment, UserComp, csv_photos
@@ -15,7 +14,8 @@ from model import Photo, Comment, UserComp, csv_photos
 class PhotoView(BaseHandler):
     def get(self, photo_id=0):
         '''View a photograph'''
-        user_id, user = self.get_user()
+        user = self.get_session()
+        user_id = user.id if user else None
 
         photo_id = int(photo_id)
         photo = Photo.get_by_id(photo_id)
@@ -64,7 +64,7 @@ class PhotoView(BaseHandler):
         if not photo.competition:
             return True
         # all photos in completed competitons can be viewed
-        if photo.competition.get().status == COMPLETED:
+        if photo.comp_status == COMPLETED:
             return True
         # a user can view all their own photos at any time
         if user and photo.user == user.key:
@@ -74,10 +74,9 @@ class PhotoView(BaseHandler):
     def _can_comment(self, user, photo):
         if not user:
             return False
-        comp = photo.competition
-        if comp is None:
+        if photo.competition is None:
             return True
-        if comp.get().status == COMPLETED:
+        if photo.comp_status == COMPLETED:
             return True
         return False
 
@@ -110,13 +109,19 @@ class PhotoView(BaseHandler):
         new_comment = Comment(
             photo=photo.key,
             user=user.key,
-            text=comment
+            username=user.username,
         )
+        new_comment.set_text(comment)
         new_comment.put()
 
         # keep track of the total number of comments
         photo.comment_count += 1
         photo.put()
+        sections = [cache.COMMENTS]
+        if photo.comp_status == COMPLETED:
+            # the competition's results page shows the comment counts
+            sections.append(cache.competition(photo.competition.id()))
+        cache.bump(*sections)
 
         # send an email to the photographer and commentators, letting them
         # know of the new comment
@@ -140,6 +145,8 @@ class PhotoView(BaseHandler):
         )
         body = body.format(user.username, comment, photo_id)
 
+        # only this code path sends mail
+        from google.appengine.api import mail
         try:
             email = mail.EmailMessage(
                 sender='HMPC Bot <gdrummondk@gmail.com>',
@@ -209,6 +216,11 @@ class PhotoDelete(BaseHandler):
 
         photo = data['photo']
         photo.delete()
+        # the photo's comments, results and showcase entry have gone
+        sections = [cache.COMMENTS, cache.RESULTS, cache.SHOWCASE]
+        if photo.competition:
+            sections.append(cache.competition(photo.competition.id()))
+        cache.bump(*sections)
 
         referrer = str(self.request.get('referrer'))
         if 'photo' in referrer:
@@ -294,11 +306,3 @@ class PhotoCSV(BaseHandler):
         logging.info('User: %s downloading photo data' % user.username)
         self.response.content_type = 'text/csv'
         self.write(csv_photos())
-
-
-routes = [
-    (r'/photo/(\d+)', PhotoView),
-    (r'/photo/delete/(\d+)', PhotoDelete),
-    (r'/photo/photos.csv', PhotoCSV)
-]
-app = webapp2.WSGIApplication(routes=routes, debug=True)
@@ -1,18 +1,21 @@
 #!/usr/bin/env python
 
-import webapp2
-
 import logging
 from collections import defaultdict
 
+import cache
 from model import (
     User,
     Photo,
     Comment,
-    Scores,
+    Ballot,
+    CompetitionStats,
     Note,
     UserStats,
     Competition,
+    lookup,
+    lookup_multi,
+    prefetch,
 )
 from handler import BaseHandler
 from helper import COMPLETED
@@ -77,17 +80,9 @@ PAIRINGS = [
 
 class Stats(BaseHandler):
     def get(self):
-        user_id, logged_user = self.get_user()
-        scores = []
-        for user_stats in UserStats.query().fetch():
-            user = user_stats.user.get()
-            score = sum(getattr(user_stats, attr) * points
-                        for attr, points in PAIRINGS)
-            if score > 0:
-                scores.append((score, user.username))
-
-        scores.sort(reverse=True)
-        logging.info('scores: %s' % scores)
+        logged_user = self.get_session()
+        # the scores only change when the stats are recalculated
+        scores = cache.value(cache.STATS, 'scores', self.scores)
 
         data = {
             'user': logged_user,
@@ -97,6 +92,21 @@ class Stats(BaseHandler):
 
         self.render('stats.html', **data)
 
+    @staticmethod
+    def scores():
+        '''Return a list of (score, username) for the scoreboard.'''
+        scores = []
+        for user_stats in prefetch(UserStats.query(), 'user'):
+            user = lookup(user_stats.user)
+            score = sum(getattr(user_stats, attr) * points
+                        for attr, points in PAIRINGS)
+            if score > 0:
+                scores.append((score, user.username))
+
+        scores.sort(reverse=True)
+        logging.info('scores: %s' % scores)
+        return scores
+
 
 class StatsCalculator(BaseHandler):
     def get(self):
@@ -114,13 +124,16 @@ class StatsCalculator(BaseHandler):
             user_stat.logouts = user.logout_count
             user_stat.bio = 1 if user.bio else 0
 
+        # photo id -> id of the photographer
+        photo_users = {}
         for photo in Photo.query().fetch():
             user_id = photo.user.id()
+            photo_users[photo.key.id()] = user_id
             user_stat = data[user_id]
             if photo.competition is None:
                 user_stat.extra_photos += 1
             else:
-                if photo.competition.get().status != COMPLETED:
+                if photo.comp_status != COMPLETED:
                     # not interested in competition photos for incomplete
                     # competitions
                     continue
@@ -145,21 +158,23 @@ class StatsCalculator(BaseHandler):
             # give
             data[comment.user.id()].comments_give += 1
             # receive
-            receiver = comment.photo.get().user.id()
+            receiver = photo_users[comment.photo.id()]
             data[receiver].comments_receive += 1
 
-        for score in Scores.query().fetch():
-            receiver = score.photo.get().user.id()
-            if score.score == 10:
-                # give 10
-                data[score.user_from.id()].score_10_give += 1
-                # receive 10
-                data[receiver].score_10_receive += 1
-            elif score.score == 0:
-                # give 0
-                data[score.user_from.id()].score_0_give += 1
-                # receive 0
-                data[receiver].score_0_recieve += 1
+        for ballot in Ballot.query():
+            giver = data[ballot.user.id()]
+            for photo_id, score in zip(ballot.photos, ballot.scores):
+                receiver = data[photo_users[photo_id]]
+                if score == 10:
+                    # give 10
+                    giver.score_10_give += 1
+                    # receive 10
+                    receiver.score_10_receive += 1
+                elif score == 0:
+                    # give 0
+                    giver.score_0_give += 1
+                    # receive 0
+                    receiver.score_0_receive += 1
 
         for note in Note.query().fetch():
             data[note.user.id()].notes += 1
@@ -192,6 +207,7 @@ class StatsCalculator(BaseHandler):
         UserStats.delete_all()
         for stat in data.values():
             stat.put()
+        cache.bump(cache.STATS)
 
         logging.info(data)
         logging.info('stats calculator...finished')
@@ -230,9 +246,10 @@ class StatsCalculator(BaseHandler):
             return
 
         max_comments = max(comment_count.values())
+        lookup_multi(comment_count.keys())
         for photo, comments in comment_count.items():
             if comments == max_comments:
-                user_id = photo.get().user.id()
+                user_id = lookup(photo).user.id()
                 data[user_id].most_comments_photo = 1
 
     def _photo_with_high_score(self, data):
@@ -243,12 +260,19 @@ class StatsCalculator(BaseHandler):
         Note: only need to consider first placed photos.
         '''
         results = defaultdict(list)
-        for photo in Photo.query(Photo.position == 1):
-            comp = photo.competition.get()
-            photo_count = comp.users().count()
+        photos = list(Photo.query(Photo.position == 1))
+        stats = lookup_multi([
+            CompetitionStats.key_for(photo.competition) for photo in photos
+        ])
+        for photo, comp_stats in zip(photos, stats):
+            photo_count = comp_stats.participants if comp_stats else 0
+            if photo_count < 2:
+                continue
             # max score for photo in a competition: 10 * (photo_count - 1)
             percent_score = photo.total_score / (10.0 * (photo_count - 1))
             results[percent_score].append(photo)
+        if not results:
+            return
         max_score = max(results.keys())
         for photo in results[max_score]:
             data[photo.user.id()].high_score_photo += 1
@@ -267,10 +291,3 @@ class StatsCalculator(BaseHandler):
                 user.full_house = 1
             elif not any(medals):
                 user.empty_house = 1
-
-
-routes = [
-    (r'/stats', Stats),
-    (r'/stats-calc', StatsCalculator),
-]
-app = webapp2.WSGIApplication(routes=routes, debug=True)
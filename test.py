@@ -6,16 +6,28 @@ from datetime import date
 from itertools import product
 from glob import glob
 from google.appengine.api import files
+from google.appengine.api.images import get_serving_url
 from google.appengine.ext.blobstore import delete as delete_blob
+from google.appengine.ext import ndb
 import os
 from random import randint
-import webapp2
 from webapp2_extras.security import generate_password_hash
 
 import logging
 
 from handler import BaseHandler
-from model import Competition, User, Photo, UserComp, Scores, Comment
+from model import (
+    Ballot,
+    Comment,
+    Competition,
+    CompetitionStats,
+    Photo,
+    User,
+    UserComp,
+    UserEmail,
+    UserName,
+    UserPending,
+)
 
 
 class Test(BaseHandler):
@@ -49,14 +61,13 @@ class Test(BaseHandler):
         users = []
         for name, email, password, verified, admin in data:
             hash_pass = generate_password_hash(password)
-            user = User(
-                username=name,
-                email=email,
+            user = User.register(
+                name,
+                email,
                 password=hash_pass,
                 verified=verified,
                 admin=admin
             )
-            user.put()
             users.append(user)
         return users
 
@@ -104,13 +115,16 @@ class Test(BaseHandler):
 
             photo = Photo(
                 user=user.key,
+                username=user.username,
                 competition=comp.key,
+                comp_status=comp.status,
                 blob=blob_key,
+                serving_url=get_serving_url(blob_key),
                 title=title
             )
             photo.put()
             p.append(photo)
-            user_comp = UserComp(user=user.key, comp=comp.key)
+            user_comp = UserComp.add_entry(user.key, photo)
             if comp == comp1:
                 user_comp.submitted_scores = True
             user_comp.put()
@@ -123,28 +137,30 @@ class Test(BaseHandler):
         logging.info(comp)
         logging.info(photos)
         logging.info(comp_photos)
-        scores = []
-        for photo, user in product(comp_photos, users):
-            if photo.user.get() == user:
-                continue
-            score = Scores(
-                photo=photo.key,
-                user_from=user.key,
-                score=randint(1, 10)
+        stats = CompetitionStats.get_for(comp.key)
+        for user in users:
+            scores = dict(
+                (photo.key.id(), randint(1, 10))
+                for photo in comp_photos if photo.user != user.key
             )
-            logging.info(score)
-            score_key = score.put()
-            logging.info(score_key)
-            scores.append(score)
+            ballot = Ballot(
+                key=Ballot.key_for(user.key, comp.key),
+                user=user.key,
+                comp=comp.key,
+                username=user.username,
+                photos=scores.keys(),
+                scores=scores.values()
+            )
+            logging.info(ballot)
+            ballot.put()
+            stats.add_ballot(scores)
+        stats.put()
 
         # calculate total scores
         results = []
         for photo in comp_photos:
             logging.info(photo)
-            total_score = 0
-            for score in scores:
-                if score.photo == photo.key:
-                    total_score += score.score
+            total_score = stats.photo_total(photo.key)
             logging.info('total score: %s' % total_score)
             results.append((total_score, photo))
         results.sort(reverse=True)
@@ -162,14 +178,16 @@ class Test(BaseHandler):
             prev_score = score
 
     def _delete_all(self):
-        for base in (Competition, UserComp, Scores, Comment):
+        for base in (Competition, UserComp, Ballot, CompetitionStats, Comment,
+                     UserPending):
             for item in base.query():
                 item.key.delete()
         for photo in Photo.query():
             delete_blob(photo.blob)
             photo.key.delete()
         for user in User.gql('WHERE username != :1', 'test'):
-            user.key.delete()
-
-
-app = webapp2.WSGIApplication([('/_admin', Test)], debug=True)
+            ndb.delete_multi([
+                UserName.key_for(user.username),
+                UserEmail.key_for(user.email),
+                user.key
+            ])
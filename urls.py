@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+'''The application: one WSGIApplication which serves every page.
+
+The handlers are given by their import paths, so webapp2 imports a handler
+module the first time one of its pages is requested. A new instance only
+pays for the modules of the pages it actually serves.
+'''
+
+import webapp2
+
+routes = [
+    # main
+    (r'/', 'main.Home'),
+    (r'/about', 'main.About'),
+
+    # user_admin
+    (r'/login', 'user_admin.Login'),
+    (r'/login-as', 'user_admin.LoginAs'),
+    (r'/logout', 'user_admin.Logout'),
+    (r'/register', 'user_admin.Register'),
+    (r'/contact', 'user_admin.Contact'),
+    (r'/verify/(.+)', 'user_admin.VerifyUser'),
+    (r'/reset', 'user_admin.Reset'),
+    (r'/password/(.+)', 'user_admin.Password'),
+
+    # user
+    (r'/user/(\d+)', 'user.UserView'),
+    (r'/upload', 'user.Upload'),
+    (r'/user/edit', 'user.UserViewEdit'),
+    (r'/competitors', 'user.Competitors'),
+
+    # photo
+    (r'/photo/(\d+)', 'photo.PhotoView'),
+    (r'/photo/delete/(\d+)', 'photo.PhotoDelete'),
+    (r'/photo/photos.csv', 'photo.PhotoCSV'),
+
+    # comment
+    (r'/comment/edit/(\d+)', 'comment.CommentEdit'),
+    (r'/comments', 'comment.Comments'),
+
+    # competition
+    (r'/competitions', 'competition.Competitions'),
+    (r'/competition/(\d+)', 'competition.CompetitionHandler'),
+    (r'/competition/admin', 'competition.CompetitionAdmin'),
+    (r'/competition/new', 'competition.CompetitionNew'),
+    (r'/competition/modify/(\d+)', 'competition.CompetitionModify'),
+    (r'/competition/reconcile/(\d+)', 'competition.CompetitionReconcile'),
+    (r'/competition/scores/(\d+)/scores_\d+.csv',
+        'competition.CompetitionScores'),
+    (r'/competition/delete/(\d+)', 'competition.CompetitionDelete'),
+    (r'/competition/delete-task', 'competition.CompetitionDeleteTask'),
+
+    # note
+    (r'/notes', 'note.Notes'),
+    (r'/note/edit/(\d+)', 'note.NoteEdit'),
+    (r'/note/delete/(\d+)', 'note.NoteDelete'),
+    (r'/note/new', 'note.NoteNew'),
+
+    # stats
+    (r'/stats', 'stats.Stats'),
+    (r'/stats-calc', 'stats.StatsCalculator'),
+
+    # help
+    (r'/help/comments', 'help.help.Comments'),
+    (r'/help/denormalize', 'help.help.Denormalize'),
+    (r'/help/markdown', 'help.help.RenderMarkdown'),
+    (r'/help/serving-urls', 'help.help.ServingUrls'),
+    (r'/help/showcase', 'help.help.RebuildShowcase'),
+    (r'/help/rekey', 'help.help.Rekey'),
+    (r'/help/ballots', 'help.help.MigrateBallots'),
+    (r'/help/competition-stats', 'help.help.CompetitionCounts'),
+    (r'/help/user-index', 'help.help.UserIndex'),
+    (r'/help/exif/(\d+)', 'help.help.ExifData'),
+    (r'/help/cache', 'help.help.CacheStats'),
+
+    # test data
+    (r'/_admin', 'test.Test'),
+
+    (r'/_ah/warmup', 'warmup.Warmup'),
+]
+
+app = webapp2.WSGIApplication(routes=routes, debug=True)
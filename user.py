@@ -1,14 +1,26 @@
 #!/usr/bin/env python
 
+from google.appengine.api.images import get_serving_url
 from google.appengine.ext import blobstore
 from google.appengine.ext.webapp import blobstore_handlers
-import webapp2
 
 import logging
 
+import cache
 from handler import BaseHandler
-from model import User, Photo, UserComp, Competition, UserStats, blob_exif
-from helper import MONTHS, OPEN, MAX_EXTRA_PHOTO
+from model import (
+    User,
+    Photo,
+    UserComp,
+    Competition,
+    UserPending,
+    UserStats,
+    blob_exif,
+    lookup,
+    lookup_multi,
+    prefetch,
+)
+from helper import MONTHS, MAX_EXTRA_PHOTO
 
 
 class UserView(BaseHandler):
@@ -31,8 +43,12 @@ class UserView(BaseHandler):
 
         if my_page:
             photos = Photo.user_photos(user)
-            need_scores = list(user.scoring_competitions())
-            need_photos = self._competitions_need_photos(user)
+            generation = cache.generations(
+                [cache.COMPETITIONS])[cache.COMPETITIONS]
+            pending = UserPending.get_for(user.key, generation)
+            comps = lookup_multi(pending.need_scores + pending.need_photos)
+            need_scores = filter(None, comps[:len(pending.need_scores)])
+            need_photos = filter(None, comps[len(pending.need_scores):])
         else:
             photos = Photo.user_photos_complete(user_view)
             need_scores = []
@@ -59,16 +75,6 @@ class UserView(BaseHandler):
 
         self.render('user-view.html', **data)
 
-    def _competitions_need_photos(self, user):
-        '''Return a list of all competitions for which the user can submit a
-        photograph.'''
-        submissions = []
-        for comp in Competition.get_by_status(OPEN):
-            usercomp = UserComp.get_usercomp(user, comp)
-            if not usercomp:
-                submissions.append(comp)
-        return submissions
-
     def post(self):
         pass
 
@@ -130,10 +136,16 @@ class Upload(BaseHandler, blobstore_handlers.BlobstoreUploadHandler):
             extra_data = self._extra_photo(user)
         else:
             extra_data = self._comp_photo(user)
+            if not extra_data:
+                blob_info.delete()
+                self._already_entered(user)
+                return
 
         photo_data = {
             'user': user.key,
+            'username': user.username,
             'blob': blob_info.key(),
+            'serving_url': get_serving_url(blob_info.key()),
         }
 
         exif = blob_exif(blob_info.key())
@@ -145,8 +157,29 @@ class Upload(BaseHandler, blobstore_handlers.BlobstoreUploadHandler):
         photo.put()
         logging.info('new photo: %s' % photo)
 
+        if photo.competition and not UserComp.add_entry(user.key, photo):
+            # another upload to the competition got there first
+            logging.warning('duplicate entry, deleting: %s', photo)
+            photo.key.delete()
+            blob_info.delete()
+            self._already_entered(user)
+            return
+
         self.redirect('/user/%d' % user_id)
 
+    def _already_entered(self, user):
+        '''Render the error for a second photograph in a competition.'''
+        data = {
+            'user': user,
+            'public_profile': True,
+            'page_title': 'Upload error',
+            'error': (
+                'You have already submitted a photograph to this '
+                'competition.'
+            )
+        }
+        self.render('upload_error.html', **data)
+
     def _extra_photo(self, user):
         photo_title = self.request.get('photo-extra-title')
         month = int(self.request.get('photo-extra-month'))
@@ -158,9 +191,14 @@ class Upload(BaseHandler, blobstore_handlers.BlobstoreUploadHandler):
         photo_title = self.request.get('photo-title')
         comp_id = int(self.request.get('comp-id'))
         comp = Competition.get_by_id(comp_id)
-        usercomp = UserComp(user=user.key, comp=comp.key)
-        usercomp.put()
-        return {'competition': comp.key, 'title': photo_title}
+        if UserComp.get_usercomp(user, comp):
+            # only one photo per user per competition
+            return None
+        return {
+            'competition': comp.key,
+            'comp_status': comp.status,
+            'title': photo_title
+        }
 
 
 class UserViewEdit(BaseHandler):
@@ -184,7 +222,7 @@ class UserViewEdit(BaseHandler):
             return
 
         bio = self.request.get('bio')
-        user.bio = bio
+        user.set_bio(bio)
         user.put()
 
         self.redirect('/user/%d' % user_id)
@@ -192,10 +230,10 @@ class UserViewEdit(BaseHandler):
 
 class Competitors(BaseHandler):
     def get(self):
-        user_id, user = self.get_user()
+        user = self.get_session()
 
-        users = list(UserStats.query().fetch())
-        users.sort(key=lambda u: u.user.get().username.lower())
+        users = prefetch(UserStats.query(), 'user')
+        users.sort(key=lambda u: lookup(u.user).username.lower())
 
         data = {
             'page_title': 'Competitors',
@@ -204,11 +242,3 @@ class Competitors(BaseHandler):
         }
 
         self.render('competitors.html', **data)
-
-routes = [
-    (r'/user/(\d+)', UserView),
-    (r'/upload', Upload),
-    (r'/user/edit', UserViewEdit),
-    (r'/competitors', Competitors),
-]
-app = webapp2.WSGIApplication(routes=routes, debug=True)
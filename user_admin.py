@@ -5,10 +5,8 @@ password reset, and contact.
 """
 
 import datetime
-from google.appengine.api import mail
 import logging
 import re
-import webapp2
 from webapp2_extras.security import (
     generate_password_hash,
     check_password_hash,
@@ -16,7 +14,7 @@ from webapp2_extras.security import (
 )
 
 from handler import BaseHandler
-from model import User
+from model import User, ResetToken
 
 
 class BaseUser(BaseHandler):
@@ -36,13 +34,6 @@ class BaseUser(BaseHandler):
         hash_pass = user.password
         return check_password_hash(password, hash_pass)
 
-    def set_cookie(self, user):
-        user_id = user.key.id()
-        username = user.username
-        template = '%d|%s' % (user_id, username)
-        value = self.cookie_serializer.serialize('userid', template)
-        self.response.set_cookie('userid', value)
-
 
 class Logout(BaseHandler):
     def get(self):
@@ -117,7 +108,7 @@ class Login(BaseUser):
         user.put()
 
         # user exists - set cookie and redirect
-        self.set_cookie(user)
+        self.set_session(user)
         self.redirect('/user/%d' % user.key.id())
 
 
@@ -164,7 +155,7 @@ class LoginAs(BaseUser):
             self.render('error.html', **{'error_msg': "Can't find other user"})
             return
 
-        self.set_cookie(other_user)
+        self.set_session(other_user)
         self.redirect('/user/%d' % other_user.key.id())
 
 
@@ -202,16 +193,25 @@ class Register(BaseUser):
             # no errors so create new user
             hash_pass = generate_password_hash(password)
             verify_code = generate_random_string(length=30)
-            user = User(
-                username=username,
+            user = User.register(
+                username,
+                email,
                 password=hash_pass,
-                email=email,
                 verify_code=verify_code
             )
-            user.put()
+            if not user:
+                # someone else registered the name or email address first
+                errors.append(
+                    'That user name or email address is already in use, '
+                    'please choose another one.'
+                )
+                logging.warning('Register: lost race for %s', username)
+                self.render('register.html', **data)
+                return
             logging.info('Register: successfully created user: %s', user)
             # send email to admin about new user
             body = 'Username: %s\nEmail: %s' % (user.username, user.email)
+            from google.appengine.api import mail
             mail.send_mail_to_admins(
                 'gdrummondk@gmail.com',
                 'hmpc: new user',
@@ -220,7 +220,7 @@ class Register(BaseUser):
             # send user verification email to user's email address
             self.send_verification_email(username, email, verify_code)
             # set the cookie
-            #self.set_cookie(user)
+            #self.set_session(user)
             self.redirect('/')
 
     def send_verification_email(self, username, email, verify_code):
@@ -236,6 +236,7 @@ class Register(BaseUser):
             'address bar) to verify your user account on HMPC.\n\n'
             'http://prelude-hmpc.appspot.com/verify/%s\n'
         )
+        from google.appengine.api import mail
         mail.send_mail('gdrummondk@gmail.com', to, subject, body % verify)
 
     def input_errors(self, username, password, validate, email):
@@ -368,9 +369,8 @@ class Reset(BaseHandler):
                 expire = datetime.datetime.now()
                 expire += datetime.timedelta(hours=1)
                 code = generate_random_string(length=30)
-                user.pass_reset_code = code
-                user.pass_reset_expire = expire
-                user.put()
+                token = ResetToken(id=code, user=user.key, expires=expire)
+                token.put()
 
                 subject = 'HMPC: request to change password'
                 logging.info('generated verify code: %s' % code)
@@ -383,6 +383,7 @@ class Reset(BaseHandler):
                     'the login page to login.\n\n'
                     'http://prelude-hmpc.appspot.com/password/%s\n'
                 )
+                from google.appengine.api import mail
                 mail.send_mail(
                     'gdrummondk@gmail.com',
                     email,
@@ -408,15 +409,14 @@ class Password(BaseHandler):
             'errors': errors,
         }
         logging.info('code: %s', code)
-        user = User.user_from_reset_code(code)
-        if not user:
+        token = ResetToken.get_by_id(code)
+        if not token:
             errors.append(
                 'This is not a valid password reset code. You can request '
                 'another password reset code or contact admin for help.'
             )
         else:
-            expired = user.pass_reset_expire < datetime.datetime.now()
-            if expired:
+            if token.expired():
                 errors.append(
                     'The password reset code has expired - you submitted this '
                     'request more than an hour ago. Please make another '
@@ -443,17 +443,13 @@ class Password(BaseHandler):
                 "again."
             )
         else:
-            user = User.user_from_reset_code(code)
+            hash_pass = generate_password_hash(password)
+            user = ResetToken.use(code, hash_pass)
             if not user:
                 errors.append(
                     'No account for this reset code! Please contact admin.'
                 )
             else:
-                hash_pass = generate_password_hash(password)
-                user.password = hash_pass
-                user.pass_reset_code = None
-                user.pass_reset_expire = None
-                user.put()
                 self.redirect('/login')
                 return
 
@@ -478,6 +474,7 @@ class Contact(BaseHandler):
             }
         else:
             body = 'name: %s\nemail: %s\n\n%s' % (name, email, message)
+            from google.appengine.api import mail
             mail.send_mail_to_admins('gdrummondk@gmail.com', 'hmpc', body)
             data = {
                 'message_sent': True,
@@ -496,15 +493,3 @@ class Contact(BaseHandler):
         if extra_data:
             data.update(extra_data)
         self.render('contact.html', **data)
-
-routes = [
-    ('/login', Login),
-    ('/login-as', LoginAs),
-    ('/logout', Logout),
-    ('/register', Register),
-    ('/contact', Contact),
-    ('/verify/(.+)', VerifyUser),
-    ('/reset', Reset),
-    ('/password/(.+)', Password)
-]
-app = webapp2.WSGIApplication(routes=routes, debug=True)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+'''The warmup request, which App Engine sends to a new instance before it
+serves any users.'''
+
+import importlib
+import logging
+import time
+
+from handler import BaseHandler
+from model import reset_identity_map
+import urls
+
+
+class Warmup(BaseHandler):
+    '''Do the work of a cold start - imports, template compilation and
+    loading the data every visitor needs - and log how long each step
+    took. BaseHandler starts the request with an empty identity map.'''
+    def get(self):
+        try:
+            self.prime()
+        finally:
+            # the primed entities must not be seen by the next request
+            reset_identity_map()
+
+    def prime(self):
+        started = time.time()
+        self.timings = []
+
+        modules = sorted(set(
+            handler.rsplit('.', 1)[0] for _, handler in urls.routes
+        ))
+        for module in modules:
+            self.step('import %s' % module, importlib.import_module, module)
+
+        # imported above, by the handler modules
+        from handler import env
+        import main
+
+        self.step('render base.html',
+                  lambda: env.get_template('base.html').render())
+        self.step('load home.html', env.get_template, 'home.html')
+        self.step('home page sections', main.Home.sections)
+
+        total = (time.time() - started) * 1000
+        logging.info('warmup: total %.0f ms', total)
+        self.write('\n'.join(
+            ['%6.0f ms  %s' % (ms, name) for name, ms in self.timings]
+            + ['%6.0f ms  total' % total]
+        ))
+
+    def step(self, name, function, *args):
+        '''Call the function and log how long it took.'''
+        started = time.time()
+        result = function(*args)
+        ms = (time.time() - started) * 1000
+        self.timings.append((name, ms))
+        logging.info('warmup: %s took %.0f ms', name, ms)
+        return result